@@ -16,12 +16,13 @@ function _rename() {
     
     local options
     options="-h --help --debug -v --verbose -n --dry-run -r --recursive --dir-only --exclude --include"
+    options="$options -j --jobs --no-cache --profile --stream --journal --resume --durable --sync-every --plan"
     options="$options -b -e -E"
     options="$options --index --index-from --index-to --indexr-from --indexr-to"
     options="$options --text --text-from --text-to --textx-from --textx-to"
     options="$options --char-num --char-non-num --char-alpha --char-non-alpha --char-alnum --char-non-alnum --char-upper --char-lower"
     options="$options --pattern"
-    options="$options test add remove replace lower upper camel sentence fill keep swap number cut dir"
+    options="$options test add remove replace lower upper camel sentence fill keep swap number cut dir undo apply"
     # set program options as default
     local words="$options"
 
@@ -66,6 +67,10 @@ function _rename() {
                 words="-h --help"
                 commandFound=true
                 ;;
+            undo | apply)
+                words="-h --help"
+                commandFound=true
+                ;;
             number)
                 words="-h --help -e -b -a -w -s --start -i --increment --replace --no-reset"
                 commandFound=true
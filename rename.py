@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 import argparse
 import time
 import logging
@@ -13,9 +14,17 @@ from textparser import TokenType
 import re
 from textwrap import dedent
 from pathlib import Path
+from stat import S_ISDIR, S_ISLNK
 from enum import Enum
-from functools import cached_property
+from types import MappingProxyType
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
 import fnmatch
+import json
+import sqlite3
+import threading
+import errno
+from functools import lru_cache
 try:
     from mutagen.mp3 import MP3
     SUPPORT_MUTAGEN = True
@@ -37,6 +46,10 @@ CMD_FILL = 'fill'
 CMD_CUT = 'cut'
 CMD_KEEP = 'keep'
 CMD_DIR = 'dir'
+CMD_UNDO = 'undo'
+CMD_APPLY = 'apply'
+# commands that change each file independently of all other files
+STATELESS_COMMANDS = (CMD_ADD, CMD_REMOVE, CMD_REPLACE, CMD_LOWERCASE, CMD_UPPERCASE, CMD_CAMELCASE, CMD_SENTENCECASE, CMD_SWAP, CMD_CUT, CMD_KEEP, CMD_DIR)
 
 # placeholders
 PH_FILENAME = '|f|'
@@ -56,6 +69,7 @@ PH_AUDIO_ARTIST = '|artist|'
 PH_AUDIO_ALBUM = '|album|'
 PH_AUDIO_TRACK = '|track|'
 PH_AUDIO_NO = '|no|'
+AUDIO_PLACEHOLDERS = (PH_AUDIO_ARTIST, PH_AUDIO_ALBUM, PH_AUDIO_TRACK, PH_AUDIO_NO)
 
 PLACEHOLDERS = { PH_FILENAME : 'File name', PH_BASENAME : 'Base name', PH_EXT : 'Extension', PH_SELECTED : 'Selected text',
     PH_FOLDER_0 : 'Folder', PH_FOLDER_1 : 'Parent folder', PH_FOLDER_2 : 'Parent folder 2', PH_FOLDER_3 : 'Parent folder 3', 
@@ -70,6 +84,12 @@ AT_GREEDY = '?'
 AT_NUMBER = 'n'
 AT_ALPHABETS = 'a'
 
+# audio metadata stored in the metadata cache
+AUDIO_KEYS = ('artist', 'album', 'title', 'tracknumber')
+METADATA_CACHE_MAX_SIZE = 32 * 1024 * 1024
+# number of journal records between two fsync calls
+JOURNAL_SYNC_EVERY = 1000
+
 # colors
 ANSI_END = '\033[0m'
 ANSI_BOLD = '\033[1m'
@@ -83,6 +103,56 @@ class RenameError(Exception):
     def __init__(self, msg):
         self.msg = msg
 
+class Profiler:
+    """Measures wall time and number of calls per phase (option --profile)."""
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def add(self, phase, seconds, calls=1):
+        with self.lock:
+            entry = self.phases.setdefault(phase, [0, 0.0])
+            entry[0] += calls
+            entry[1] += seconds
+
+    def measure(self, phase, calls=1):
+        """Return a context manager that measures the enclosed code."""
+        if not self.enabled:
+            return nullcontext()
+        return self._measure(phase, calls)
+
+    @contextmanager
+    def _measure(self, phase, calls):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start, calls)
+
+    def iterate(self, phase, iterable):
+        """Yield all items of the iterable and measure the time to get them."""
+        if not self.enabled:
+            yield from iterable
+            return
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.add(phase, time.perf_counter() - start, 0)
+                return
+            self.add(phase, time.perf_counter() - start)
+            yield item
+
+    def report(self):
+        if not self.enabled:
+            return
+        print(f'{ANSI_BOLD}{"Phase":<20} {"Calls":>10} {"Time":>12}{ANSI_END}', file=sys.stderr)
+        for phase, (calls, seconds) in self.phases.items():
+            print(f'{phase:<20} {calls:>10} {seconds:>10.3f} s', file=sys.stderr)
+
 class SelectPatternNameAttribute:
     def __init__(self, name):
         split = name.split(':')
@@ -154,6 +224,10 @@ class SelectPatternHandler:
     """Handler for option --pattern."""
     def __init__(self, pattern):
         self.patternTokens = self._parsePattern(pattern)
+        # (placeholder name, regex group name, selected) for all placeholders of the pattern
+        self.groups = [ (t.nameAttr.placeholderName, t.nameAttr.regExGroupName, t.nameAttr.selected) for t in self.patternTokens 
+            if t.type == TokenType.PLACEHOLDER and PH_ESCAPE != t.nameAttr.placeholderName ]
+        self.selectionAttributeAvailable = any(selected for _, _, selected in self.groups)
         regexString = ''.join(t.toRegex() for t in self.patternTokens)
         try:
             logging.debug(f'Pattern tokens: {f"{ANSI_DIM} | {ANSI_END}".join(str(t) for t in self.patternTokens)}')
@@ -170,47 +244,82 @@ class SelectPatternHandler:
             tokens.append(SelectPatternToken(tt.type, tt.value))
         return tokens
         
-    def parseToken(self, token, path, args):
+    def parseSpan(self, name, start, end, path, args):
         # https://docs.python.org/3/library/re.html
-        match = self.regex.match(token.text)
+        match = self.regex.match(name[start:end])
         if not match:
-            return [ FilenameToken(token.text, False) ]
+            return [ (start, end, False) ]
 
-        # only needed if a token is marked as selected
-        selectionFilenameTokens = []
-        selectionAttributeAvailable = False
+        patternPlaceholders = { placeholderName: match.group(groupName) for placeholderName, groupName, _ in self.groups }
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('Pattern placeholders for %s: %s', name[start:end], patternPlaceholders)
+        if not self.selectionAttributeAvailable:
+            # create single span for the whole pattern
+            return [ (start, end, True, patternPlaceholders) ]
 
-        patternPlaceholders = {}
-        for patternToken in self.patternTokens:
-            if patternToken.type == TokenType.PLACEHOLDER and PH_ESCAPE != patternToken.nameAttr.placeholderName:
-                matchedText = match.group(patternToken.nameAttr.regExGroupName)
-                patternPlaceholders[patternToken.nameAttr.placeholderName] = matchedText
-                
-                selectionFilenameTokens.append(FilenameToken(matchedText, patternToken.nameAttr.selected, patternPlaceholders))
-                selectionAttributeAvailable |= patternToken.nameAttr.selected
-            else:
-                selectionFilenameTokens.append(FilenameToken(patternToken.value, False, None))
-        
-        if selectionAttributeAvailable:
-            # create new filename tokens for each PatternToken
-            if logging.getLogger().isEnabledFor(logging.DEBUG):
-                for t in selectionFilenameTokens:
-                    if t.change:
-                        logging.debug(f'{t}: {t.patternPlaceholders}')
-            return selectionFilenameTokens
-        else:
-            # create single filename token for the whole pattern
-            logging.debug(f'Pattern placeholders for {token}: {patternPlaceholders}')
-            return [ FilenameToken(token.text, True, patternPlaceholders) ]
+        # create new spans for each placeholder, the text between the placeholders is not selected
+        spans = []
+        pos = start
+        for _, groupName, selected in self.groups:
+            groupStart, groupEnd = match.span(groupName)
+            if start + groupStart > pos:
+                spans.append((pos, start + groupStart, False))
+            spans.append((start + groupStart, start + groupEnd, selected, patternPlaceholders))
+            pos = start + groupEnd
+        if start + match.end() > pos:
+            spans.append((pos, start + match.end(), False))
+        return spans
             
+class SelectCharHandler:
+    """Handler for options --char-*: selects runs of chars for which func(char) is true.
+    
+    The runs are found by a regex with a char class. Regex classes like \\d differ from str.isnumeric() etc., so the 
+    class contains the chars that have been seen in file names and for which func is true. 
+    It is extended and compiled again when a file name contains new chars.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.knownChars = set()
+        self.selectedChars = []
+        self.regex = re.compile('(?!)')
+
+    def _addChars(self, text):
+        newChars = set(text).difference(self.knownChars)
+        self.knownChars.update(newChars)
+        selectedChars = [ c for c in newChars if self.func(c) ]
+        if selectedChars:
+            self.selectedChars.extend(selectedChars)
+            self.regex = re.compile(f'[{"".join(re.escape(c) for c in sorted(self.selectedChars))}]+')
+
+    def parseSpan(self, name, start, end, path, args):
+        if not self.knownChars.issuperset(name):
+            self._addChars(name)
+        # the first span is never selected, it is empty if the first char is selected
+        spans = []
+        pos = start
+        for match in self.regex.finditer(name, start, end):
+            spans.append((pos, match.start(), False))
+            pos = match.end()
+            spans.append((match.start(), pos, True))
+        if pos < end or not spans:
+            spans.append((pos, end, False))
+        return spans
+
 class FilenameParser:
     """Parser a file name and creates FilenameToken's."""
-    def __init__(self):
+    def __init__(self, profiler=None):
+        self.profiler = profiler if profiler else Profiler(False)
         self.selectorLevel1 = []
         self.selectorLevel2 = []
         self.selectorLevel3 = []
         self.selectorLevel4 = []
         self.selectorLevel5 = []
+        self.selectPattern = None
+        # set by getTokens() for the selectors: debug messages are only built if they are logged
+        self.debug = False
+        # (level, selectors) set by init()
+        self.levels = []
+        self.activeLevels = []
 
     def init(self, args):
         # basename/ext
@@ -249,197 +358,196 @@ class FilenameParser:
                 
         # char
         if args.charNum:
-            self.selectorLevel4.append(self._selectCharNum)
+            self.selectorLevel4.append(SelectCharHandler(lambda c: c.isnumeric()).parseSpan)
         elif args.charNonNum:
-            self.selectorLevel4.append(self._selectcharNonNum)
+            self.selectorLevel4.append(SelectCharHandler(lambda c: not c.isnumeric()).parseSpan)
         elif args.charAlpha:
-            self.selectorLevel4.append(self._selectCharAlpha)
+            self.selectorLevel4.append(SelectCharHandler(lambda c: c.isalpha()).parseSpan)
         elif args.charNonAlpha:
-            self.selectorLevel4.append(self._selectCharNonAlpha)
+            self.selectorLevel4.append(SelectCharHandler(lambda c: not c.isalpha()).parseSpan)
         elif args.charAlnum:
-            self.selectorLevel4.append(self._selectCharAlnum)
+            self.selectorLevel4.append(SelectCharHandler(lambda c: c.isalnum()).parseSpan)
         elif args.charNonAlnum:
-            self.selectorLevel4.append(self._selectCharNonAlnum)
+            self.selectorLevel4.append(SelectCharHandler(lambda c: not c.isalnum()).parseSpan)
         elif args.charUpper:
-            self.selectorLevel4.append(self._selectCharUpper)
+            self.selectorLevel4.append(SelectCharHandler(lambda c: c.isupper()).parseSpan)
         elif args.charLower:
-            self.selectorLevel4.append(self._selectCharLower)
+            self.selectorLevel4.append(SelectCharHandler(lambda c: c.islower()).parseSpan)
         
         # pattern
         if args.pattern:
-            selectPattern = SelectPatternHandler(args.pattern)
-            self.selectorLevel5.append(selectPattern.parseToken)
-
-    def _selectBasename(self, token, path, args):
-        return [ FilenameToken(path.stem, True), FilenameToken(path.suffix, False) ]
-    def _selectExt(self, token, path, args):
-        stem = FilenameToken(path.stem, False)
-        ext = path.suffix
-        if not ext:
-            return [ stem ]
+            self.selectPattern = SelectPatternHandler(args.pattern)
+            self.selectorLevel5.append(self.selectPattern.parseSpan)
+
+        self.levels = list(enumerate((self.selectorLevel1, self.selectorLevel2, self.selectorLevel3, self.selectorLevel4, self.selectorLevel5), 1))
+        self.activeLevels = [ (level, selectors) for level, selectors in self.levels if selectors ]
+
+    def getCustomPlaceholders(self):
+        """Return the placeholders defined by the --pattern option."""
+        if self.selectPattern is None:
+            return set()
+        return set(t.nameAttr.placeholderName for t in self.selectPattern.patternTokens 
+            if t.type == TokenType.PLACEHOLDER and PH_ESCAPE != t.nameAttr.placeholderName)
+
+    # Selectors split the selected span name[start:end] and return a list of spans (start, end, selected). 
+    # Spans refer to the original file name, strings are only created for the final tokens.
+    def _selectBasename(self, name, start, end, path, args):
+        stemEnd = len(path.stem)
+        return [ (0, stemEnd, True), (stemEnd, len(name), False) ]
+    def _selectExt(self, name, start, end, path, args):
+        stemEnd = len(path.stem)
+        if stemEnd == len(name):
+            return [ (0, stemEnd, False) ]
         else:
             # remove leading dot from extension
-            return [ stem, FilenameToken(ext[0], False), FilenameToken(ext[1:], True) ]
-    def _selectExtWithDot(self, token, path, args):
-        stem = FilenameToken(path.stem, False)
-        ext = path.suffix
-        if not ext:
-            return [ stem ]
+            return [ (0, stemEnd, False), (stemEnd, stemEnd+1, False), (stemEnd+1, len(name), True) ]
+    def _selectExtWithDot(self, name, start, end, path, args):
+        stemEnd = len(path.stem)
+        if stemEnd == len(name):
+            return [ (0, stemEnd, False) ]
         else:
-            return [ stem, FilenameToken(path.suffix, True) ]
+            return [ (0, stemEnd, False), (stemEnd, len(name), True) ]
 
-    def _selectIndex(self, token, path, args):
-        index = args.selectIndex-1
-        logging.debug(f'Split token "{token.text}" by index: {index}')
-        try:
-            return [ FilenameToken(token.text[:index], False), FilenameToken(token.text[index], True), FilenameToken(token.text[index+1:], False) ]
-        except IndexError as e:
-            logging.debug(e)
-            return [ FilenameToken(token.text, False) ]
-    def _selectIndexRange(self, token, path, args):
+    def _selectIndex(self, name, start, end, path, args):
+        index = start + args.selectIndex-1
+        if self.debug:
+            logging.debug('Split span %s:%s by index: %s', start, end, index)
+        if index >= end:
+            return [ (start, end, False) ]
+        return [ (start, index, False), (index, index+1, True), (index+1, end, False) ]
+    def _selectIndexRange(self, name, start, end, path, args):
         indexFrom = None
         if args.selectIndexFrom or args.selectIndexRightFrom:
             indexFrom = args.selectIndexFrom-1 if args.selectIndexFrom else -1*args.selectIndexRightFrom
         indexTo = None
         if args.selectIndexTo or args.selectIndexRightTo:
             indexTo = args.selectIndexTo if args.selectIndexTo else -1*args.selectIndexRightTo+1
-        logging.debug(f'Split token "{token.text}" by index: {indexFrom}:{indexTo}')
+        if self.debug:
+            logging.debug('Split span %s:%s by index: %s:%s', start, end, indexFrom, indexTo)
 
-        selectedText = token.text[indexFrom:indexTo]
-        if not selectedText:
-            # no text could be extracted, return original token
-            return [ FilenameToken(token.text, False) ]
+        # same bounds as name[start:end][indexFrom:indexTo]
+        selectedFrom, selectedTo, _ = slice(indexFrom, indexTo).indices(end - start)
+        if selectedFrom >= selectedTo:
+            # no text could be extracted, return original span
+            return [ (start, end, False) ]
 
+        selectedFrom += start
+        selectedTo += start
         if indexFrom is not None and indexTo is not None:
-            return [ FilenameToken(token.text[:indexFrom], False), FilenameToken(selectedText, True), FilenameToken(token.text[indexTo:], False) ]
+            return [ (start, selectedFrom, False), (selectedFrom, selectedTo, True), (selectedTo, end, False) ]
         elif indexFrom is not None:
-            return [ FilenameToken(token.text[:indexFrom], False), FilenameToken(selectedText, True) ]
+            return [ (start, selectedFrom, False), (selectedFrom, selectedTo, True) ]
         elif indexTo is not None:
-            return [ FilenameToken(selectedText, True), FilenameToken(token.text[indexTo:], False) ]
+            return [ (selectedFrom, selectedTo, True), (selectedTo, end, False) ]
         else:
             # this case should not be possible, nothing will be changed
-            return token
-
-    def _selectText(self, token, path, args):
-        split = token.text.split(args.selectText)
-        logging.debug(f'Split token by text: {args.selectText} -> {split}')
-        t = []
-        for s in split:
-            if t:
-                # do not append token for the first item: "a-b".split("-") -> [ "a", "b" ]
-               t.append(FilenameToken(args.selectText, True))
-            t.append(FilenameToken(s, False))
-        return t
-    def _selectTextFrom(self, token, path, args):
-        # https://docs.python.org/3/library/stdtypes.html#bytes.partition
-        partition = token.text.partition(args.selectTextFrom)
-        logging.debug(f'Split token by text from: {args.selectTextFrom} -> {partition}')
-        if not partition[1] and not partition[2]:
-            # string not found if partions 1+2 are empty -> partition 0 contains original text
-            return [ FilenameToken(partition[0], False) ]
+            return [ (start, end, False) ]
+
+    def _selectText(self, name, start, end, path, args):
+        text = args.selectText
+        if self.debug:
+            logging.debug('Split span %s:%s by text: %s', start, end, text)
+        # split is faster than searching in a loop, only the lengths of the parts are used
+        parts = name[start:end].split(text)
+        spans = []
+        pos = start
+        for part in parts:
+            if spans:
+                # do not append span for the first item: "a-b".split("-") -> [ "a", "b" ]
+                spans.append((pos, pos + len(text), True))
+                pos += len(text)
+            spans.append((pos, pos + len(part), False))
+            pos += len(part)
+        return spans
+    def _selectTextFrom(self, name, start, end, path, args):
+        found = name.find(args.selectTextFrom, start, end)
+        if self.debug:
+            logging.debug('Split span %s:%s by text from: %s -> %s', start, end, args.selectTextFrom, found)
+        if found < 0:
+            return [ (start, end, False) ]
         else:
-            return [ FilenameToken(partition[0], False), FilenameToken(partition[1]+partition[2], True) ]
-    def _selectTextXFrom(self, token, path, args):
-        partition = token.text.partition(args.selectTextExclFrom)
-        logging.debug(f'Split token by text from (excluded): {args.selectTextExclFrom} -> {partition}')
-        if not partition[1] and not partition[2]:
-            # string not found if partions 1+2 are empty -> partition 0 contains original text
-            return [ FilenameToken(partition[0], False) ]
+            return [ (start, found, False), (found, end, True) ]
+    def _selectTextXFrom(self, name, start, end, path, args):
+        found = name.find(args.selectTextExclFrom, start, end)
+        if self.debug:
+            logging.debug('Split span %s:%s by text from (excluded): %s -> %s', start, end, args.selectTextExclFrom, found)
+        if found < 0:
+            return [ (start, end, False) ]
         else:
-            return [ FilenameToken(partition[0]+partition[1], False), FilenameToken(partition[2], True) ]
-    def _selectTextTo(self, token, path, args):
-        partition = token.text.partition(args.selectTextTo)
-        logging.debug(f'Split token by text from (excluded): {args.selectTextTo} -> {partition}')
-        if not partition[1] and not partition[2]:
-            # string not found if partions 1+2 are empty -> partition 0 contains original text
-            return [ FilenameToken(partition[0], False) ]
+            found += len(args.selectTextExclFrom)
+            return [ (start, found, False), (found, end, True) ]
+    def _selectTextTo(self, name, start, end, path, args):
+        found = name.find(args.selectTextTo, start, end)
+        if self.debug:
+            logging.debug('Split span %s:%s by text to: %s -> %s', start, end, args.selectTextTo, found)
+        if found < 0:
+            return [ (start, end, False) ]
         else:
-            return [ FilenameToken(partition[0]+partition[1], True), FilenameToken(partition[2], False) ]
-    def _selectTextXTo(self, token, path, args):
-        partition = token.text.partition(args.selectTextExclTo)
-        logging.debug(f'Split token by text from (excluded): {args.selectTextExclTo} -> {partition}')
-        if not partition[1] and not partition[2]:
-            # string not found if partions 1+2 are empty -> partition 0 contains original text
-            return [ FilenameToken(partition[0], False) ]
+            found += len(args.selectTextTo)
+            return [ (start, found, True), (found, end, False) ]
+    def _selectTextXTo(self, name, start, end, path, args):
+        found = name.find(args.selectTextExclTo, start, end)
+        if self.debug:
+            logging.debug('Split span %s:%s by text to (excluded): %s -> %s', start, end, args.selectTextExclTo, found)
+        if found < 0:
+            return [ (start, end, False) ]
         else:
-            return [ FilenameToken(partition[0], True), FilenameToken(partition[1]+partition[2], False) ]
-
-    def _selectCharNum(self, token, path, args):
-        return self._selectCharHelper(token, path, args, lambda c: c.isnumeric())
-    def _selectcharNonNum(self, token, path, args):
-        return self._selectCharHelper(token, path, args, lambda c: not c.isnumeric())
-    def _selectCharAlpha(self, token, path, args):
-        return self._selectCharHelper(token, path, args, lambda c: c.isalpha())
-    def _selectCharNonAlpha(self, token, path, args):
-        return self._selectCharHelper(token, path, args, lambda c: not c.isalpha())
-    def _selectCharAlnum(self, token, path, args):
-        return self._selectCharHelper(token, path, args, lambda c: c.isalnum())
-    def _selectCharNonAlnum(self, token, path, args):
-        return self._selectCharHelper(token, path, args, lambda c: not c.isalnum())
-    def _selectCharUpper(self, token, path, args):
-        return self._selectCharHelper(token, path, args, lambda c: c.isupper())
-    def _selectCharLower(self, token, path, args):
-        return self._selectCharHelper(token, path, args, lambda c: c.islower())
-    def _selectCharHelper(self, token, path, args, func):
-        t = []
-        tmp = FilenameToken('', False)
-        for c in token.text:
-            isdigit = func(c)
-            if isdigit and tmp.change:
-                tmp.text += c
-            elif not isdigit and not tmp.change:
-                tmp.text += c
-            elif isdigit and not tmp.change:
-                t.append(tmp)
-                tmp = FilenameToken(c, True)
-            elif not isdigit and tmp.change:
-                t.append(tmp)
-                tmp = FilenameToken(c, False)
-        t.append(tmp)
-        return t
+            return [ (start, found, True), (found, end, False) ]
 
     def getTokens(self, path, args):
-        filePath = path.relative_to(os.getcwd()) if path.is_relative_to(os.getcwd()) else path
-        logging.debug(f'Get tokens for "{filePath}"')
-        tokens = [ FilenameToken(path.name, True) ]
-        logging.debug(f'Level 0: Tokens of "{filePath}": {f"{ANSI_DIM} | {ANSI_END}".join(str(t) for t in tokens)}')
-        for l1 in self.selectorLevel1:
-            tokens = self._replaceChangeTokens(tokens, l1, path, args)
-        logging.debug(f'Level 1: Tokens of "{filePath}": {f"{ANSI_DIM} | {ANSI_END}".join(str(t) for t in tokens)}')
-        for l2 in self.selectorLevel2:
-            tokens = self._replaceChangeTokens(tokens, l2, path, args)
-        logging.debug(f'Level 2: Tokens of "{filePath}": {f"{ANSI_DIM} | {ANSI_END}".join(str(t) for t in tokens)}')
-        for l3 in self.selectorLevel3:
-            tokens = self._replaceChangeTokens(tokens, l3, path, args)
-        logging.debug(f'Level 3: Tokens of "{filePath}": {f"{ANSI_DIM} | {ANSI_END}".join(str(t) for t in tokens)}')
-        for l4 in self.selectorLevel4:
-            tokens = self._replaceChangeTokens(tokens, l4, path, args)
-        logging.debug(f'Level 4: Tokens of "{filePath}": {f"{ANSI_DIM} | {ANSI_END}".join(str(t) for t in tokens)}')
-        for l5 in self.selectorLevel5:
-            tokens = self._replaceChangeTokens(tokens, l5, path, args)
-        logging.debug(f'=> Tokens of "{filePath}": {f"{ANSI_DIM} | {ANSI_END}".join(str(t) for t in tokens)}')
-        # validate tokens
-        for t in tokens:
-            if t.change and not t.text:
+        # build debug messages only if they are logged
+        self.debug = debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        profile = self.profiler.enabled
+        name = path.name
+        if debug:
+            filePath = relativeToCwd(path)
+            logging.debug(f'Get tokens for "{filePath}"')
+        spans = [ (0, len(name), True) ]
+        if debug:
+            logging.debug(f'Level 0: Tokens of "{filePath}": {self._formatSpans(name, spans)}')
+        for level, selectors in (self.levels if debug else self.activeLevels):
+            if profile:
+                start = time.perf_counter()
+            for selector in selectors:
+                spans = self._replaceSelectedSpans(name, spans, selector, path, args)
+            if profile:
+                self.profiler.add(f'select level {level}', time.perf_counter() - start)
+            if debug:
+                prefix = f'Level {level}: Tokens' if level < len(self.levels) else '=> Tokens'
+                logging.debug(f'{prefix} of "{filePath}": {self._formatSpans(name, spans)}')
+        tokens = []
+        for span in spans:
+            if span[2] and span[0] == span[1]:
                 # selected text must not be empty
                 raise RenameError(f'{path}: Parsing failed: Token is empty')
+            # spans of the --pattern option contain the pattern placeholders as 4th item
+            tokens.append(FilenameToken(name[span[0]:span[1]], span[2], span[3] if len(span) > 3 else None))
         return tokens
 
-    def _replaceChangeTokens(self, tokens, selector, path, args):
-        newTokens = []
-        for token in tokens:
-            if token.change:
-                newTokens.extend(selector(token, path, args))
+    def _replaceSelectedSpans(self, name, spans, selector, path, args):
+        newSpans = []
+        for span in spans:
+            if span[2]:
+                newSpans.extend(selector(name, span[0], span[1], path, args))
             else:
-                newTokens.append(token)
-        return newTokens
+                newSpans.append(span)
+        return newSpans
+
+    @staticmethod
+    def _formatSpans(name, spans):
+        return f"{ANSI_DIM} | {ANSI_END}".join(f'{ANSI_CYAN}{name[s[0]:s[1]]}{ANSI_END}' if s[2] else name[s[0]:s[1]] for s in spans)
+
+# shared by all tokens without placeholders from the --pattern option, read only
+NO_PATTERN_PLACEHOLDERS = MappingProxyType({})
 
 class FilenameToken:
     """Part of a file name."""
-    def __init__(self, text, change, patternPlaceholders={}):
+    __slots__ = ('text', 'change', 'patternPlaceholders')
+
+    def __init__(self, text, change, patternPlaceholders=None):
         self.text = text
         self.change = change
-        self.patternPlaceholders = patternPlaceholders
+        self.patternPlaceholders = patternPlaceholders if patternPlaceholders is not None else NO_PATTERN_PLACEHOLDERS
         
     def updateText(self, newText, end):
         if end:
@@ -455,10 +563,30 @@ class FilenameToken:
 
 class FileRenamer:
     """Renames a file."""
-    def __init__(self, path, tokens):
-        self.path = path.resolve()
+    # kept per file until the end of the run: less than 2 KB with its tokens (see test_memory_per_file)
+    __slots__ = ('path', 'tokens', 'metadataCache', 'entry', 'done', 'tmpPath', '_dstPath', '_dstFile', '_dstKey', 
+        '_srcFile', '_srcKey', '_stat', '_mtime', '_audio')
+
+    def __init__(self, path, tokens, metadataCache=None, entry=None):
+        # path must be resolved
+        self.path = path
         self.tokens = tokens
+        self.metadataCache = metadataCache
+        # DirEntry or stat result from the enumeration
+        self.entry = entry
         self.done = False
+        # temporary location of the file if it had to give way to another file (see RenameScheduler)
+        self.tmpPath = None
+        # destination computed by freeze()
+        self._dstPath = None
+        self._dstFile = None
+        self._dstKey = None
+        # computed on first access
+        self._srcFile = None
+        self._srcKey = None
+        self._stat = None
+        self._mtime = None
+        self._audio = None
         # ensure that file name is equal with tokens
         tokenFileName = "".join(t.text for t in self.tokens)
         if self.path.name != tokenFileName:
@@ -470,100 +598,124 @@ class FileRenamer:
         return next((t for t in self.tokens if t.change), None)
    
     def getSrcFile(self):
-        return self.path.relative_to(os.getcwd()) if self.path.is_relative_to(os.getcwd()) else self.path
+        return self.srcFile
+
+    @property
+    def srcFile(self):
+        """Source path for display: relative to the working directory if possible."""
+        if self._srcFile is None:
+            self._srcFile = relativeToCwd(self.path)
+        return self._srcFile
+
+    @property
+    def srcKey(self):
+        if self._srcKey is None:
+            self._srcKey = pathKey(self.path)
+        return self._srcKey
+
+    def freeze(self, dstPath=None):
+        """Compute the destination once after the tokens were changed by a command or use the given destination. 
+        Call again if the tokens are changed afterwards."""
+        self._dstPath = dstPath if dstPath is not None else self.path.parent / "".join(t.text for t in self.tokens)
+        self._dstFile = relativeToCwd(self._dstPath)
+        self._dstKey = pathKey(self._dstPath)
     
+    def getDstPath(self):
+        """Return the absolute destination path."""
+        if self._dstPath is not None:
+            return self._dstPath
+        return self.path.parent / "".join(t.text for t in self.tokens)
+
     def getDstFile(self):
-        newFilename = "".join(t.text for t in self.tokens)
-        newPath = self.path.parent / newFilename
-        return newPath.relative_to(os.getcwd()) if newPath.is_relative_to(os.getcwd()) else newPath
+        if self._dstFile is not None:
+            return self._dstFile
+        return relativeToCwd(self.getDstPath())
+
+    def getDstKey(self):
+        if self._dstKey is not None:
+            return self._dstKey
+        return pathKey(self.getDstPath())
     
-    def resolvePlaceholders(self, text, token):
-        tokens = textparser.tokenize(text, sep='|', includeSep=True)
-        logging.debug(f'Resolve placeholder tokens for "{self.getSrcFile()}": {f"{ANSI_DIM} | {ANSI_END}".join(str(t) for t in tokens)}')
-        
-        resolvedText = ''
-        for t in tokens:
-            if t.isText():
-                resolvedText += t.value
-            else:
-                resolvedText += self.replaceSinglePlaceholder(t.value, token)
-        return resolvedText
-        
     def replaceSinglePlaceholder(self, placeholder, token, raiseIfNotFound=True):
         """Return the resolved text for the given placeholder."""
-        if PH_FILENAME == placeholder:
-            return self.path.name
-        if PH_BASENAME == placeholder:
-            return self.path.stem
-        if PH_EXT == placeholder:
-            return self.path.suffix[1:]
-        if PH_SELECTED == placeholder:
-            token = self.getFirstTokenToChange()
-            if token:
-                return token.text
-        if PH_MODIFICATIONDATE == placeholder:
-            mTimestamp = self.path.stat().st_mtime
-            mDate = time.strftime("%Y-%m-%d", time.gmtime(mTimestamp))
-            return mDate
-        if PH_MODIFICATIONDATE_YEAR == placeholder:
-            mTimestamp = self.path.stat().st_mtime
-            mDate = time.strftime("%Y", time.gmtime(mTimestamp))
-            return mDate
-        if PH_MODIFICATIONDATE_MONTH == placeholder:
-            mTimestamp = self.path.stat().st_mtime
-            mDate = time.strftime("%m", time.gmtime(mTimestamp))
-            return mDate
-        if PH_MODIFICATIONDATE_DAY == placeholder:
-            mTimestamp = self.path.stat().st_mtime
-            mDate = time.strftime("%d", time.gmtime(mTimestamp))
-            return mDate
-        # folders
-        phFolders = {PH_FOLDER_0: 2, PH_FOLDER_1: 3, PH_FOLDER_2: 4, PH_FOLDER_3: 5}
-        for ph in phFolders:
-            if ph == placeholder:
-                parts = self.path.parts
-                if len(parts) >= phFolders[ph]:
-                    return parts[-phFolders[ph]]
-        # metadata 
-        if SUPPORT_MUTAGEN and self.path.suffix == '.mp3':
-            if PH_AUDIO_ARTIST == placeholder or PH_AUDIO_ALBUM == placeholder or PH_AUDIO_TRACK == placeholder or PH_AUDIO_NO == placeholder:
-                # https://mutagen.readthedocs.io/en/latest/user/id3.html
-                # https://stackoverflow.com/questions/71468239/function-to-write-id3-tag-with-python-3-mutagen
-                # logging.debug('All available keys: ' + str(EasyID3.valid_keys.keys()))
-                audio = self._easyID3
-                if PH_AUDIO_ARTIST == placeholder and 'artist' in audio:
-                    return audio['artist'][0]
-                if PH_AUDIO_ALBUM == placeholder and 'album' in audio:
-                    return audio['album'][0]
-                if PH_AUDIO_TRACK == placeholder and 'title' in audio:
-                    return audio['title'][0]
-                if PH_AUDIO_NO == placeholder and 'tracknumber' in audio:
-                    tracknumber = audio['tracknumber'][0]
-                    return f'{tracknumber:>02}'
-        
-        # placeholders from --pattern option
-        if token is not None:
-            for ph in token.patternPlaceholders:
-                if ph == placeholder:
-                    return token.patternPlaceholders[ph]
-
-        # escape
-        if PH_ESCAPE == placeholder:
-            return '|'
+        text = getPlaceholderResolver(placeholder)(self, token)
+        if text is not None:
+            return text
         if raiseIfNotFound:
             raise RenameError(f'Error: Cannot resolve placeholder "{placeholder}"')
         return placeholder
+
+    # resolvers for placeholders: return the text or None if the placeholder cannot be resolved
+    def _resolveSelected(self, token):
+        token = self.getFirstTokenToChange()
+        return token.text if token else None
+
+    def _resolveFolder(self, level):
+        parts = self.path.parts
+        return parts[-level] if len(parts) >= level else None
+
+    def _resolveAudio(self, key):
+        if not self.hasAudioMetadata():
+            return None
+        # https://mutagen.readthedocs.io/en/latest/user/id3.html
+        # https://stackoverflow.com/questions/71468239/function-to-write-id3-tag-with-python-3-mutagen
+        audio = self._audioMetadata
+        return audio[key][0] if key in audio else None
+
+    def _resolveAudioNumber(self):
+        tracknumber = self._resolveAudio('tracknumber')
+        return f'{tracknumber:>02}' if tracknumber is not None else None
     
-    @cached_property
-    def _easyID3(self):
+    @property
+    def stat(self):
+        """Return the stat result of the file. It is only taken once and shared by all placeholders."""
+        if self._stat is None:
+            # on Windows the stat result of DirEntry has no device and inode, which identify the file in 
+            # MetadataCache and RenamePlan
+            if isinstance(self.entry, os.DirEntry):
+                self._stat = self.entry.stat() if os.name != 'nt' else self.path.stat()
+            elif self.entry is not None:
+                self._stat = self.entry
+            else:
+                self._stat = self.path.stat()
+        return self._stat
+
+    @property
+    def _modificationTime(self):
+        if self._mtime is None:
+            self._mtime = time.gmtime(self.stat.st_mtime)
+        return self._mtime
+
+    def hasAudioMetadata(self):
+        """Check if audio placeholders can be resolved for this file."""
+        return SUPPORT_MUTAGEN and self.path.suffix == '.mp3'
+
+    @property
+    def _audioMetadata(self):
+        """Return the audio metadata as dict, e.g. { 'artist': ['The Artist'] }."""
+        if self._audio is None:
+            self._audio = self._loadAudioMetadata()
+        return self._audio
+
+    def _loadAudioMetadata(self):
+        stat = None
+        if self.metadataCache is not None:
+            stat = self.stat
+            audio = self.metadataCache.get(stat)
+            if audio is not None:
+                logging.debug('Audio metadata from cache: %s', audio)
+                return audio
         from mutagen.easyid3 import EasyID3
-        logging.debug(f'Create EasyID3 object for "{self.getSrcFile()}"')
-        audio = EasyID3(self.path)
-        logging.debug(f'Audio metadata: {audio}')
+        logging.debug('Create EasyID3 object for "%s"', self.path)
+        easyID3 = EasyID3(self.path)
+        logging.debug('Audio metadata: %s', easyID3)
+        audio = { key: list(easyID3[key]) for key in AUDIO_KEYS if key in easyID3 }
+        if self.metadataCache is not None:
+            self.metadataCache.put(stat, audio)
         return audio
         
-    def renameDryRun(self, deletedFiles, createdFiles):
-        """Only return True if DstFile does not exist."""
+    def renameDryRun(self, fs):
+        """Simulate the renaming with the given DryRunFileSystem and return True if succeeded."""
         src = self.getSrcFile()
         dst = self.getDstFile()
         if self.done:
@@ -577,52 +729,677 @@ class FileRenamer:
                 print(f'{ANSI_DIM}{src}: File name not changed{ANSI_END}')
                 self.done = True
                 return False
-        elif (os.path.exists(dst) and dst not in deletedFiles) or dst in createdFiles:
+        elif fs.exists(self.getDstPath()):
             # file cannot be renamed
             return False
         else:
             print(f'{src} -> {dst}')
+            fs.move(self.tmpPath if self.tmpPath else self.path, self.getDstPath())
+            self.tmpPath = None
             self.done = True
             return True
-        return False
     
-    def rename(self, args):
-        """Rename the file and return True if succeeded."""
+    def rename(self, args, journal=None, folderSync=None):
+        """Rename the file and return True if succeeded. The move is recorded in the given RenameJournal, 
+        the changed folders are added to the given FolderSync."""
         src = self.getSrcFile()
         dst = self.getDstFile()
         if self.done:
             return False
-        elif src == dst:
-            if str(src) != str(dst):
-                msg = f'{src} -> {dst}'
-                print(msg) if args.verbose else logging.debug(msg)
-                
-                # file system is case insensitive: temp move "src" to "src.<RANDOM>"
-                randomPostfix = ''.join(random.choices(string.ascii_uppercase + string.digits, k=5))
-                tmpSrc = str(src) + f'.{randomPostfix}'
-                logging.debug(f'Use tmp file: {tmpSrc}')
-                if not os.path.exists(tmpSrc):
-                    shutil.move(src, tmpSrc)
-                    # IMPORTANT: this case can only happen if src == dst (never overwrite dst otherwise)
-                    shutil.move(tmpSrc, dst)
-                    self.done = True
-                    return True
-                return False
+        elif str(src) == str(dst):
+            print(f'{ANSI_DIM}{src}: File name not changed{ANSI_END}')
+            self.done = True
+            return False
+        
+        caseOnly = self.tmpPath is None and str(src).lower() == str(dst).lower() and not isCaseSensitiveFolder(self.path)
+        if caseOnly:
+            # file system is case insensitive and dst is the name of src: temp move "src" to "src.<RANDOM>"
+            self.moveToTemp(journal=journal)
+        # no check if dst exists: the move fails if it exists
+        srcPath = self.tmpPath if self.tmpPath else src
+        try:
+            with recordMove(journal, self.tmpPath if self.tmpPath else self.path, self.getDstPath()):
+                try:
+                    moveNoReplace(srcPath, dst)
+                except FileNotFoundError:
+                    if os.path.exists(dst.parent):
+                        raise
+                    os.makedirs(dst.parent, exist_ok=True)
+                    moveNoReplace(srcPath, dst)
+        except FileExistsError:
+            logging.debug('File exists: %s', dst)
+            if caseOnly:
+                self.restoreFromTemp(journal=journal)
+            return False
+        print(f'{src} -> {dst}') if args.verbose else logging.debug('%s -> %s', src, dst)
+        if folderSync is not None:
+            folderSync.add((self.path.parent, self.getDstPath().parent))
+        self.tmpPath = None
+        self.done = True
+        return True
+
+    def moveToTemp(self, fs=None, journal=None):
+        """Move the file to a temporary name in the same folder to release its name for another file."""
+        while True:
+            tmpPath = getTempPath(self.path, fs)
+            logging.debug(f'Use tmp file: {tmpPath}')
+            if fs:
+                fs.move(self.path, tmpPath)
+                break
+            try:
+                with recordMove(journal, self.path, tmpPath):
+                    moveNoReplace(self.path, tmpPath)
+                break
+            except FileExistsError:
+                # created by another process in the meantime: try another name
+                logging.debug('Tmp file exists: %s', tmpPath)
+        self.tmpPath = tmpPath
+
+    def restoreFromTemp(self, fs=None, journal=None):
+        """Move the file back from its temporary name if it could not be renamed."""
+        if not self.tmpPath:
+            return
+        if fs:
+            if not fs.exists(self.path):
+                fs.move(self.tmpPath, self.path)
+                self.tmpPath = None
+            return
+        logging.debug(f'Restore tmp file: {self.tmpPath} -> {self.path}')
+        try:
+            with recordMove(journal, self.tmpPath, self.path):
+                moveNoReplace(self.tmpPath, self.path)
+        except FileExistsError:
+            # the name was taken by another file: keep the temporary name
+            print(f'{ANSI_RED}{relativeToCwd(self.path)}: File exists, kept as {relativeToCwd(self.tmpPath)}{ANSI_END}')
+            return
+        self.tmpPath = None
+
+class DryRunFileSystem:
+    """In-memory model of the folders affected by a dry run."""
+    def __init__(self):
+        # folder key -> set of names, each folder is listed once when it is accessed for the first time
+        self.folders = {}
+
+    def _getNames(self, folder):
+        key = pathKey(folder)
+        names = self.folders.get(key)
+        if names is None:
+            try:
+                names = set(os.path.normcase(n) for n in os.listdir(folder))
+            except OSError:
+                # folder does not exist (yet)
+                names = set()
+            self.folders[key] = names
+        return names
+
+    def exists(self, path):
+        path = Path(os.path.normpath(path))
+        return os.path.normcase(path.name) in self._getNames(path.parent)
+
+    def move(self, src, dst):
+        src = Path(os.path.normpath(src))
+        dst = Path(os.path.normpath(dst))
+        self._getNames(src.parent).discard(os.path.normcase(src.name))
+        self._getNames(dst.parent).add(os.path.normcase(dst.name))
+
+class MetadataCache:
+    """Persistent cache for audio metadata in a SQLite database, entries are identified by device and inode."""
+    def __init__(self, file, maxSize=METADATA_CACHE_MAX_SIZE):
+        self.file = file
+        # the least recently used entries are removed if the database grows beyond maxSize
+        self.maxSize = maxSize
+        self.connection = None
+        self.disabled = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def getDefaultFile():
+        cacheDir = os.environ.get('XDG_CACHE_HOME') or os.path.join(Path.home(), '.cache')
+        return Path(cacheDir, 'rename', 'metadata.sqlite')
+
+    def _connect(self):
+        if self.connection is None:
+            os.makedirs(self.file.parent, exist_ok=True)
+            self.connection = sqlite3.connect(self.file, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS metadata (dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER, data TEXT, lastUsed REAL, PRIMARY KEY (dev, ino))')
+        return self.connection
+
+    def _disable(self, e):
+        logging.debug(f'Metadata cache disabled: {e}')
+        self.disabled = True
+
+    def get(self, stat):
+        """Return the cached metadata for the file with the given stat result or None."""
+        with self.lock:
+            if self.disabled:
+                return None
+            try:
+                # an entry is only used as long as size and modification time are unchanged
+                connection = self._connect()
+                row = connection.execute('SELECT size, mtime, data FROM metadata WHERE dev = ? AND ino = ?', (stat.st_dev, stat.st_ino)).fetchone()
+                if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+                    return None
+                connection.execute('UPDATE metadata SET lastUsed = ? WHERE dev = ? AND ino = ?', (time.time(), stat.st_dev, stat.st_ino))
+                return json.loads(row[2])
+            except (sqlite3.Error, OSError) as e:
+                self._disable(e)
+                return None
+
+    def put(self, stat, data):
+        """Store the metadata for the file with the given stat result."""
+        with self.lock:
+            if self.disabled:
+                return
+            try:
+                self._connect().execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)', 
+                    (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, json.dumps(data), time.time()))
+            except (sqlite3.Error, OSError) as e:
+                self._disable(e)
+
+    def close(self):
+        """Save all changes and remove old entries if the database is too large."""
+        with self.lock:
+            if self.connection is None:
+                return
+            try:
+                self.connection.commit()
+                pageCount = self.connection.execute('PRAGMA page_count').fetchone()[0]
+                pageSize = self.connection.execute('PRAGMA page_size').fetchone()[0]
+                if pageCount * pageSize > self.maxSize:
+                    # remove the least recently used half
+                    logging.debug(f'Evict metadata cache: {pageCount * pageSize} bytes')
+                    self.connection.execute('DELETE FROM metadata WHERE rowid IN (SELECT rowid FROM metadata ORDER BY lastUsed LIMIT (SELECT COUNT(*) / 2 FROM metadata))')
+                    self.connection.commit()
+                    self.connection.execute('VACUUM')
+            except sqlite3.Error as e:
+                logging.debug(f'Failed to save metadata cache: {e}')
+            finally:
+                self.connection.close()
+                self.connection = None
+
+class RenamePlan:
+    """Renames written by option --plan and renamed later by the apply command."""
+    def __init__(self, file):
+        # JSON lines: the command line ("plan"), renames with device, inode, size and modification time of the source 
+        # ("rename"), the end of each batch ("batch") and the number of renames ("end") if planning succeeded, 
+        # a batch is applied together like in the planning run
+        self.file = file
+        self.count = 0
+        try:
+            self.stream = open(file, 'x', encoding='utf-8')
+        except FileExistsError:
+            raise RenameError(f'Error: Plan "{file}" exists')
+
+    def writeRun(self, argv):
+        self.stream.write(json.dumps({ 'op': 'plan', 'argv': argv, 'cwd': os.getcwd() }) + '\n')
+
+    def write(self, renamers):
+        """Write the renames of a batch."""
+        records = []
+        for r in renamers:
+            src = str(r.path)
+            dst = str(r.getDstPath())
+            if src == dst:
+                continue
+            stat = r.stat
+            records.append({ 'op': 'rename', 'src': src, 'dst': dst, 'dev': stat.st_dev, 'ino': stat.st_ino, 'size': stat.st_size, 'mtime': stat.st_mtime_ns })
+        if records:
+            records.append({ 'op': 'batch' })
+            self.stream.write(''.join(json.dumps(record) + '\n' for record in records))
+            self.count += len(records) - 1
+
+    def close(self, completed=False):
+        """Close the file, with completed=True the plan is marked as complete."""
+        if completed:
+            self.stream.write(json.dumps({ 'op': 'end', 'count': self.count }) + '\n')
+        self.stream.close()
+
+    @staticmethod
+    def read(file):
+        """Yield the rename records of the plan file batch by batch, only one batch is kept in memory. 
+        An incomplete plan is rejected before the first batch."""
+        try:
+            f = open(file, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            raise RenameError(f'Error: Plan "{file}" does not exist')
+        with f:
+            # the end record is checked first, without reading the whole plan
+            f.buffer.seek(0, os.SEEK_END)
+            f.buffer.seek(max(0, f.buffer.tell() - 1024))
+            try:
+                end = json.loads(f.buffer.read().rstrip(b'\n').rsplit(b'\n', 1)[-1])
+            except ValueError:
+                end = None
+            if not isinstance(end, dict) or end.get('op') != 'end':
+                raise RenameError(f'Error: Plan "{file}" is incomplete, planning did not finish')
+            f.seek(0)
+            batch = []
+            count = 0
+            for lineNo, line in enumerate(f, 1):
+                try:
+                    record = json.loads(line)
+                    op = record['op']
+                except (ValueError, KeyError) as e:
+                    raise RenameError(f'Error: Plan "{file}" is corrupt in line {lineNo}: {e}')
+                if lineNo == 1:
+                    if op != 'plan':
+                        raise RenameError(f'Error: File "{file}" is not a plan')
+                    logging.debug('Apply plan of: %s (in %s)', ' '.join(record['argv']), record['cwd'])
+                elif op == 'rename':
+                    batch.append(record)
+                    count += 1
+                elif op == 'batch':
+                    yield batch
+                    batch = []
+                elif op == 'end':
+                    break
+            if batch or count != end.get('count'):
+                raise RenameError(f'Error: Plan "{file}" is corrupt, {count} of {end.get("count")} renames found')
+
+class RenameJournal:
+    """Append-only journal of a run (option --journal) to resume it with --resume or to undo it."""
+    def __init__(self, file, nextId=0, size=None, syncEvery=JOURNAL_SYNC_EVERY):
+        # JSON lines: the command line ("run"), the renames of a batch ("plan", closed by "start"), each move before 
+        # ("move") and after it ("done" or "failed"), created folders ("mkdir"), undone moves ("undo") and "end"
+        # continue an existing journal: size is the length of its complete records (see JournalContent)
+        self.file = file
+        self.nextId = nextId
+        # a killed process loses nothing, after a power failure the records since the last fsync can be missing
+        self.syncEvery = syncEvery
+        self.unsynced = 0
+        self.lock = threading.Lock()
+        if size is not None and size != os.path.getsize(file):
+            # remove an incomplete last record
+            os.truncate(file, size)
+        self.stream = open(file, 'a', encoding='utf-8')
+
+    def _write(self, records, flush=True):
+        # lock must be held
+        self.stream.write(''.join(json.dumps(record) + '\n' for record in records))
+        if flush:
+            self.stream.flush()
+        self.unsynced += len(records)
+        if self.unsynced >= self.syncEvery:
+            self.stream.flush()
+            os.fsync(self.stream.fileno())
+            self.unsynced = 0
+
+    def writeRun(self, argv):
+        with self.lock:
+            self._write([ { 'op': 'run', 'argv': argv, 'cwd': os.getcwd() } ])
+
+    def writePlan(self, renamers):
+        """Record the renames of a batch before the first file of it is moved."""
+        records = [ { 'op': 'plan', 'src': str(r.path), 'dst': str(r.getDstPath()) } for r in renamers if str(r.path) != str(r.getDstPath()) ]
+        records.append({ 'op': 'start' })
+        with self.lock:
+            self._write(records)
+
+    @contextmanager
+    def recordMove(self, src, dst):
+        """Return a context manager that records the move of src to dst by the enclosed code."""
+        with self.lock:
+            moveId = self.nextId
+            self.nextId += 1
+            self._write([ { 'op': 'move', 'id': moveId, 'src': str(src), 'dst': str(dst) } ])
+        try:
+            yield
+        except OSError:
+            with self.lock:
+                self._write([ { 'op': 'failed', 'id': moveId } ], flush=False)
+            raise
+        # written with the next move: until then the file system shows if the move was done
+        with self.lock:
+            self._write([ { 'op': 'done', 'id': moveId } ], flush=False)
+
+    def writeResult(self, moveId, done):
+        """Record the result of a move that was interrupted."""
+        with self.lock:
+            self._write([ { 'op': 'done' if done else 'failed', 'id': moveId } ], flush=False)
+
+    def writeMkdir(self, folder):
+        with self.lock:
+            self._write([ { 'op': 'mkdir', 'path': str(folder) } ], flush=False)
+
+    def writeUndo(self, moveId):
+        """Record that a move was undone after the file was moved back."""
+        with self.lock:
+            self._write([ { 'op': 'undo', 'id': moveId } ])
+
+    def close(self, completed=False):
+        """Write all records to disk, with completed=True the run is recorded as finished."""
+        with self.lock:
+            if self.stream.closed:
+                return
+            if completed:
+                self._write([ { 'op': 'end' } ])
+            self.stream.flush()
+            os.fsync(self.stream.fileno())
+            self.stream.close()
+
+def recordMove(journal, src, dst):
+    """Return a context manager that records the enclosed move in the journal if there is one."""
+    if journal is None:
+        return nullcontext()
+    return journal.recordMove(src, dst)
+
+class JournalContent:
+    """Records of a journal file (see RenameJournal)."""
+    def __init__(self, file):
+        self.file = file
+        self.argv = None
+        self.cwd = None
+        # (src, dst) of all batches whose renaming was started
+        self.plan = []
+        # move records in the order of the moves, "done" is None if the run was interrupted during the move
+        self.moves = []
+        self.folders = []
+        self.undoneIds = set()
+        self.ended = False
+        try:
+            with open(file, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            raise RenameError(f'Error: Journal "{file}" does not exist')
+        # length of the complete records
+        self.size = data.rfind(b'\n') + 1
+        lines = data.decode('utf-8', errors='replace').split('\n')
+        if lines[-1]:
+            # last record was not written completely
+            logging.debug('Ignore incomplete journal record: %s', lines[-1])
+        batch = []
+        movesById = {}
+        for lineNo, line in enumerate(lines[:-1], 1):
+            try:
+                record = json.loads(line)
+                op = record['op']
+                if op == 'run':
+                    self.argv = record['argv']
+                    self.cwd = record['cwd']
+                elif op == 'plan':
+                    batch.append((record['src'], record['dst']))
+                elif op == 'start':
+                    self.plan.extend(batch)
+                    batch = []
+                elif op == 'move':
+                    record['done'] = None
+                    movesById[record['id']] = record
+                    self.moves.append(record)
+                elif op in ('done', 'failed'):
+                    movesById[record['id']]['done'] = op == 'done'
+                elif op == 'mkdir':
+                    self.folders.append(record['path'])
+                elif op == 'undo':
+                    self.undoneIds.add(record['id'])
+                elif op == 'end':
+                    self.ended = True
+            except (ValueError, KeyError) as e:
+                raise RenameError(f'Error: Journal "{file}" is corrupt in line {lineNo}: {e}')
+        if self.argv is None:
+            raise RenameError(f'Error: Journal "{file}" contains no run')
+        self.nextId = self.moves[-1]['id'] + 1 if self.moves else 0
+
+    def isDone(self, move):
+        """Return True if the move was done. An interrupted move is checked on the file system."""
+        if move['done'] is None:
+            move['done'] = not os.path.lexists(move['src']) and os.path.lexists(move['dst'])
+            logging.debug('Interrupted move %s -> %s done: %s', move['src'], move['dst'], move['done'])
+        return move['done']
+
+class FolderSync:
+    """Collects the folders changed by renaming and calls fsync once per folder (option --durable)."""
+    def __init__(self, syncEvery=None):
+        # folders are synced at the end and after every syncEvery renames instead of after each rename
+        self.syncEvery = syncEvery
+        self.folders = set()
+        self.renames = 0
+        self.syncedFolders = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, folders, renames=1):
+        """Add the folders changed by the given number of renames and sync if a checkpoint is reached."""
+        with self.lock:
+            self.folders.update(str(f) for f in folders)
+            self.renames += renames
+            checkpoint = self.syncEvery is not None and renames and self.renames % self.syncEvery == 0
+        if checkpoint:
+            self.sync()
+
+    def sync(self):
+        """Call fsync for all folders added since the last sync."""
+        with self.lock:
+            folders = self.folders
+            self.folders = set()
+        start = time.perf_counter()
+        for folder in sorted(folders):
+            syncFolder(folder)
+        seconds = time.perf_counter() - start
+        logging.debug('Synced %s folders in %.3f s', len(folders), seconds)
+        with self.lock:
+            self.syncedFolders += len(folders)
+            self.seconds += seconds
+
+    def report(self):
+        print(f'Synced {self.syncedFolders} folders in {self.seconds:.3f} s', file=sys.stderr)
+
+def syncFolder(folder):
+    """Call fsync for a folder so that the changes of its entries are written to disk."""
+    try:
+        fd = os.open(folder, os.O_RDONLY)
+    except OSError as e:
+        # e.g. folders cannot be opened on Windows, renamed folder
+        logging.debug('Folder not synced: %s', e)
+        return
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        # e.g. EINVAL: not supported by the file system
+        logging.debug('Folder not synced: %s', e)
+    finally:
+        os.close(fd)
+
+class RenameScheduler:
+    """Renames all files in a single pass over the graph of files that occupy each other's destination."""
+    def __init__(self, renamers, fs=None, knownFolders=None, journal=None, folderSync=None):
+        self.renamers = renamers
+        # DryRunFileSystem for a dry run
+        self.fs = fs
+        # keys of the folders that exist already, can be shared by several schedulers
+        self.knownFolders = knownFolders if knownFolders is not None else set()
+        # RenameJournal to record the moves, FolderSync to collect the changed folders
+        self.journal = journal
+        self.folderSync = folderSync
+        # folders created by createFolders() in creation order
+        self.createdFolders = []
+        # a file at a temporary name (resumed run) does not occupy its source path
+        self.renamerBySrc = { r.srcKey: r for r in renamers if r.tmpPath is None }
+
+    def getDependency(self, renamer):
+        """Return the renamer that must be renamed before the given one or None."""
+        dstKey = renamer.getDstKey()
+        if dstKey == renamer.srcKey:
+            return None
+        return self.renamerBySrc.get(dstKey)
+
+    def run(self, args):
+        if self.fs is None:
+            self.createFolders()
+        try:
+            if args.jobs > 1 and self.fs is None and not args.dirOnly:
+                # renaming a folder changes the paths of all files in it, so folders are always renamed one by one
+                groups = self.getIndependentGroups()
+                logging.debug(f'Rename {len(groups)} independent groups with {args.jobs} threads')
+                with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+                    # iterate over the results to raise exceptions of the threads
+                    for _ in executor.map(lambda group: self._runSequential(group, args), groups):
+                        pass
             else:
-                print(f'{ANSI_DIM}{src}: File name not changed{ANSI_END}')
-                self.done = True
-                return False
-        elif not os.path.exists(dst):
-            msg = f'{src} -> {dst}'
-            print(msg) if args.verbose else logging.debug(msg)
+                self._runSequential(self.renamers, args)
+        finally:
+            self.removeEmptyFolders()
 
-            if not os.path.exists(dst.parent):
-                os.makedirs(dst.parent, exist_ok=True)
-            shutil.move(src, dst)
-            self.done = True
-            return True
-        return False
+    def createFolders(self):
+        """Create all missing destination folders in one sorted pass, so that parents are created before their children."""
+        known = self.knownFolders
+        known.update(pathKey(r.path.parent) for r in self.renamers)
+        missing = {}
+        for r in self.renamers:
+            folder = r.getDstPath().parent
+            key = pathKey(folder)
+            # walk up to the first known folder, so that missing parents are created too
+            while key not in known and key not in missing and folder.parent != folder:
+                missing[key] = folder
+                folder = folder.parent
+                key = pathKey(folder)
+        for key in sorted(missing):
+            try:
+                os.mkdir(missing[key])
+                if self.journal is not None:
+                    self.journal.writeMkdir(missing[key])
+                if self.folderSync is not None:
+                    self.folderSync.add((missing[key].parent,), renames=0)
+            except FileExistsError:
+                # exists already or e.g. a file with this name: renaming into it fails
+                pass
+            except OSError:
+                # e.g. no permission: the rename of the file reports the error
+                continue
+            else:
+                self.createdFolders.append(missing[key])
+            known.add(key)
+        if missing:
+            logging.debug('Created missing destination folders: %s', len(missing))
+
+    def removeEmptyFolders(self):
+        """Remove the folders created by createFolders() that are still empty, e.g. because the renames into them failed."""
+        # children were created after their parents
+        for folder in reversed(self.createdFolders):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                # not empty
+                continue
+            logging.debug('Removed empty folder: %s', folder)
+            self.knownFolders.discard(pathKey(folder))
+            if self.folderSync is not None:
+                self.folderSync.add((folder.parent,), renames=0)
+        self.createdFolders = []
+
+    def getIndependentGroups(self):
+        """Split the renamers into groups that do not share any source or destination path. 
+        Different groups can be renamed in parallel without the risk of overwriting a file."""
+        parent = list(range(len(self.renamers)))
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        indexBySrc = { r.srcKey: i for i, r in enumerate(self.renamers) }
+        indexByDst = {}
+        for i, r in enumerate(self.renamers):
+            dstKey = r.getDstKey()
+            # connect with the renamer occupying the destination and with renamers having the same destination
+            for j in (indexBySrc.get(dstKey), indexByDst.setdefault(dstKey, i)):
+                if j is not None:
+                    parent[find(i)] = find(j)
+        groups = {}
+        for i, r in enumerate(self.renamers):
+            groups.setdefault(find(i), []).append(r)
+        return list(groups.values())
+
+    def _runSequential(self, renamers, args):
+        # a file depends on the file occupying its destination: chains are renamed from their end, 
+        # cycles (e.g. a -> b, b -> a) are broken by moving one file to a temporary name
+        fs = self.fs
+        visited = set()
+        for renamer in renamers:
+            if id(renamer) in visited:
+                continue
+            # follow the dependencies until a file is found whose destination is free (or already handled)
+            chain = []
+            chainIndex = {}
+            cycleStart = None
+            r = renamer
+            while r is not None and id(r) not in visited:
+                if id(r) in chainIndex:
+                    cycleStart = chain[chainIndex[id(r)]]
+                    break
+                chainIndex[id(r)] = len(chain)
+                chain.append(r)
+                r = self.getDependency(r)
+            visited.update(chainIndex)
+
+            if cycleStart is not None:
+                logging.debug(f'Break rename cycle at "{cycleStart.getSrcFile()}"')
+                cycleStart.moveToTemp(fs, self.journal)
+            for r in reversed(chain):
+                if fs:
+                    r.renameDryRun(fs)
+                else:
+                    r.rename(args, self.journal, self.folderSync)
+            if cycleStart is not None:
+                cycleStart.restoreFromTemp(fs, self.journal)
         
+PLACEHOLDER_RESOLVERS = {
+    PH_FILENAME: lambda r, t: r.path.name,
+    PH_BASENAME: lambda r, t: r.path.stem,
+    PH_EXT: lambda r, t: r.path.suffix[1:],
+    PH_SELECTED: FileRenamer._resolveSelected,
+    PH_MODIFICATIONDATE: lambda r, t: time.strftime("%Y-%m-%d", r._modificationTime),
+    PH_MODIFICATIONDATE_YEAR: lambda r, t: time.strftime("%Y", r._modificationTime),
+    PH_MODIFICATIONDATE_MONTH: lambda r, t: time.strftime("%m", r._modificationTime),
+    PH_MODIFICATIONDATE_DAY: lambda r, t: time.strftime("%d", r._modificationTime),
+    PH_FOLDER_0: lambda r, t: r._resolveFolder(2),
+    PH_FOLDER_1: lambda r, t: r._resolveFolder(3),
+    PH_FOLDER_2: lambda r, t: r._resolveFolder(4),
+    PH_FOLDER_3: lambda r, t: r._resolveFolder(5),
+    PH_AUDIO_ARTIST: lambda r, t: r._resolveAudio('artist'),
+    PH_AUDIO_ALBUM: lambda r, t: r._resolveAudio('album'),
+    PH_AUDIO_TRACK: lambda r, t: r._resolveAudio('title'),
+    PH_AUDIO_NO: lambda r, t: r._resolveAudioNumber(),
+    PH_ESCAPE: lambda r, t: '|',
+}
+
+def getPlaceholderResolver(placeholder):
+    """Return a function (renamer, token) -> text or None for the given placeholder."""
+    resolver = PLACEHOLDER_RESOLVERS.get(placeholder)
+    if resolver is not None:
+        return resolver
+    # placeholders from --pattern option
+    return lambda r, t: t.patternPlaceholders.get(placeholder) if t is not None else None
+
+class PlaceholderTemplate:
+    """Text with placeholders. The text is parsed once and then resolved for each file without parsing."""
+    def __init__(self, text, customPlaceholders=()):
+        tokens = textparser.tokenize(text, sep='|', includeSep=True)
+        logging.debug(f'Placeholder tokens for "{text}": {f"{ANSI_DIM} | {ANSI_END}".join(str(t) for t in tokens)}')
+        self.parts = []
+        for t in tokens:
+            if t.isText():
+                self.parts.append(t.value)
+            elif t.value in PLACEHOLDERS or t.value in customPlaceholders:
+                self.parts.append((t.value, getPlaceholderResolver(t.value)))
+            else:
+                raise RenameError(f'Error: Cannot resolve placeholder "{t.value}"')
+        self.text = text if all(isinstance(p, str) for p in self.parts) else None
+
+    def resolve(self, renamer, token):
+        if self.text is not None:
+            # no placeholders
+            return self.text
+        resolvedText = []
+        for part in self.parts:
+            if isinstance(part, str):
+                resolvedText.append(part)
+            else:
+                placeholder, resolver = part
+                text = resolver(renamer, token)
+                if text is None:
+                    raise RenameError(f'Error: Cannot resolve placeholder "{placeholder}"')
+                resolvedText.append(text)
+        return ''.join(resolvedText)
+
 class TestCmd():
     def __init__(self, renamers, args):
         self.length = -1
@@ -688,7 +1465,7 @@ class FillCmd():
                 t.text = t.text.rjust(self.width, args.char)
 
 class NumberCmd():
-    def __init__(self, renamers, args):
+    def __init__(self, renamers, customPlaceholders, args):
         self.start = args.start
         self.width = args.width if args.width else -1
         if self.width == -1:
@@ -704,8 +1481,8 @@ class NumberCmd():
                 lastNo = self.start + ((max(fileCountPerFolder.values()) - 1) * args.increment)
                 self.width = len(str(lastNo))
         self.increment = args.increment
-        self.before = args.before if args.before else ""
-        self.after = args.after if args.after else ""
+        self.before = PlaceholderTemplate(args.before if args.before else "", customPlaceholders)
+        self.after = PlaceholderTemplate(args.after if args.after else "", customPlaceholders)
         self.current = args.start
         self.currentDir = None
         
@@ -719,21 +1496,23 @@ class NumberCmd():
                 self.current = self.start
         t = renamer.getFirstTokenToChange()
         if t is not None:
-            numberText = f'{renamer.resolvePlaceholders(self.before, t)}{self.current:0{self.width}d}{renamer.resolvePlaceholders(self.after, t)}'
+            numberText = f'{self.before.resolve(renamer, t)}{self.current:0{self.width}d}{self.after.resolve(renamer, t)}'
             if args.replace:
                 t.text = numberText
             else:
                 t.updateText(numberText, args.end)
         self.current += self.increment
 
-def getCommand(args, renamers):
+def getCommand(args, renamers, parser):
     """Returns a function to call for renaming. For actions that require a state, an object is created and a member function is returned."""
+    customPlaceholders = parser.getCustomPlaceholders()
     if args.command in (CMD_TEST):
         return TestCmd(renamers, args).apply
     elif args.command in (CMD_ADD):
+        template = PlaceholderTemplate(args.text, customPlaceholders)
         def add(renamer, args):
             for t in renamer.getTokensToChange():
-                addText = renamer.resolvePlaceholders(args.text, t)
+                addText = template.resolve(renamer, t)
                 t.updateText(addText, args.end)
         return add
     elif args.command in (CMD_REMOVE):
@@ -742,9 +1521,10 @@ def getCommand(args, renamers):
                 t.text = ''
         return remove
     elif args.command in (CMD_REPLACE):
+        template = PlaceholderTemplate(args.text, customPlaceholders)
         def replace(renamer, args):
             for t in renamer.getTokensToChange():
-                t.text = renamer.resolvePlaceholders(args.text, t)
+                t.text = template.resolve(renamer, t)
         return replace
     elif args.command in (CMD_LOWERCASE):
         def lowercase(renamer, args):
@@ -784,7 +1564,7 @@ def getCommand(args, renamers):
                         t.text = partition[2]+partition[1]+partition[0]
         return swap
     elif args.command in (CMD_NUMBER):
-        return NumberCmd(renamers, args).apply
+        return NumberCmd(renamers, customPlaceholders, args).apply
     elif args.command in (CMD_CUT):
         def cut(renamer, args):
             for t in renamer.getTokensToChange():
@@ -804,64 +1584,573 @@ def getCommand(args, renamers):
                     t.text = t.text[:args.index]
         return keep
     elif args.command in (CMD_DIR):
+        template = PlaceholderTemplate(args.dir if args.dir.endswith('/') else args.dir + '/', customPlaceholders)
         def dir(renamer, args):
             # only apply to files that matches the select options
             if renamer.getFirstTokenToChange() is not None:
                 firstToken = renamer.tokens[0]
-                targetDir = args.dir if args.dir.endswith('/') else args.dir + '/'
-                firstToken.text = renamer.resolvePlaceholders(targetDir, firstToken) + firstToken.text
+                firstToken.text = template.resolve(renamer, firstToken) + firstToken.text
         return dir
 
+def pathKey(path):
+    """Return a normalized key to compare paths."""
+    return os.path.normcase(os.path.normpath(path))
+
+def relativeToCwd(path):
+    """Return path relative to the working directory if it is inside, otherwise path. Same as 
+    Path.relative_to() but only compares strings, path must be absolute and normalized."""
+    cwd = os.getcwd()
+    prefix = cwd if cwd.endswith(os.sep) else cwd + os.sep
+    text = str(path)
+    if os.path.normcase(text).startswith(os.path.normcase(prefix)):
+        return Path(text[len(prefix):])
+    return path
+
+# see renameat2(2)
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1
+
+@lru_cache(maxsize=None)
+def getRenameat2():
+    """Return renameat2() of the C library or None if it is not available (Linux with glibc 2.28 or later)."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError):
+        return None
+    renameat2.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint)
+    renameat2.restype = ctypes.c_int
+    return renameat2
+
+def moveNoReplace(src, dst):
+    """Move src to dst without overwriting dst, raise FileExistsError if dst exists.
+    
+    On Linux renameat2(RENAME_NOREPLACE) checks and renames in one atomic step, otherwise link() + unlink() is used. 
+    If the file system supports neither (e.g. folders, FAT or different devices), dst is checked before os.rename(). 
+    Files on different devices are moved by moveAcrossDevices().
+    """
+    renameat2 = getRenameat2()
+    if renameat2 is not None:
+        if renameat2(AT_FDCWD, os.fsencode(src), AT_FDCWD, os.fsencode(dst), RENAME_NOREPLACE) == 0:
+            return
+        import ctypes
+        error = ctypes.get_errno()
+        if error == errno.EXDEV:
+            moveAcrossDevices(src, dst)
+            return
+        # EINVAL: flag not supported by the file system
+        if error not in (errno.EINVAL, errno.ENOSYS):
+            # OSError creates the subclass for the error, e.g. FileExistsError
+            raise OSError(error, os.strerror(error), str(src), None, str(dst))
+    try:
+        os.link(src, dst, follow_symlinks=False)
+    except FileExistsError:
+        raise
+    except OSError as e:
+        logging.debug('Hard link not possible: %s', e)
+        if os.path.lexists(dst):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), str(dst))
+        try:
+            os.rename(src, dst)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            moveAcrossDevices(src, dst)
+        return
+    os.unlink(src)
+
+# see ioctl_ficlone(2)
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 16 * 1024 * 1024
+# progress is shown for larger files that are copied to another device
+PROGRESS_MIN_SIZE = 64 * 1024 * 1024
+
+def moveAcrossDevices(src, dst):
+    """Move src to another device: copy the data and metadata and remove src only if the copy succeeded. 
+    Raise FileExistsError if dst exists."""
+    logging.debug('Move across devices: %s -> %s', src, dst)
+    stat = os.lstat(src)
+    if S_ISLNK(stat.st_mode):
+        os.symlink(os.readlink(src), dst)
+        os.unlink(src)
+    elif S_ISDIR(stat.st_mode):
+        # fails before anything is copied if dst exists
+        os.mkdir(dst)
+        try:
+            shutil.copytree(src, dst, symlinks=True, copy_function=copyFile, dirs_exist_ok=True)
+        except BaseException:
+            shutil.rmtree(dst, ignore_errors=True)
+            raise
+        shutil.rmtree(src)
+    else:
+        copyFile(src, dst)
+        os.unlink(src)
+
+def copyFile(src, dst):
+    """Copy a file with its metadata to dst, which must not exist. Remove the copy if anything fails."""
+    with open(src, 'rb') as fsrc:
+        stat = os.fstat(fsrc.fileno())
+        with open(dst, 'xb') as fdst:
+            try:
+                copyFileData(fsrc.fileno(), fdst.fileno(), stat.st_size, dst)
+                size = os.fstat(fdst.fileno()).st_size
+                if size != stat.st_size:
+                    raise OSError(errno.EIO, f'Copied {size} of {stat.st_size} bytes', str(dst))
+                # src is removed afterwards, the copy must not be lost on power failure
+                os.fsync(fdst.fileno())
+                fdst.close()
+                shutil.copystat(src, dst)
+                try:
+                    os.chown(dst, stat.st_uid, stat.st_gid)
+                except (AttributeError, PermissionError):
+                    # owner can only be changed by root, not available on Windows
+                    pass
+            except BaseException:
+                fdst.close()
+                os.unlink(dst)
+                raise
+
+def copyFileData(srcFd, dstFd, size, name):
+    """Copy size bytes between the file descriptors. Data is copied in the kernel if possible: 
+    reflink (same file system, e.g. bind mounts), copy_file_range(), sendfile() and read/write as last resort."""
+    if sys.platform.startswith('linux'):
+        import fcntl
+        try:
+            fcntl.ioctl(dstFd, FICLONE, srcFd)
+            return
+        except OSError:
+            pass
+
+    def readWrite(count):
+        data = os.read(srcFd, count)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dstFd, view):]
+        return len(data)
+    # all functions continue at the current file offsets, so the next one can take over after an error
+    copyFunctions = []
+    if hasattr(os, 'copy_file_range'):
+        copyFunctions.append(lambda count: os.copy_file_range(srcFd, dstFd, count))
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        copyFunctions.append(lambda count: os.sendfile(dstFd, srcFd, None, count))
+    copyFunctions.append(readWrite)
+
+    copied = 0
+    while copied < size:
+        try:
+            count = copyFunctions[0](min(COPY_CHUNK_SIZE, size - copied))
+        except OSError as e:
+            if len(copyFunctions) == 1 or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+            logging.debug('Copy function not supported: %s', e)
+            copyFunctions.pop(0)
+            continue
+        if count == 0:
+            # file was truncated
+            break
+        copied += count
+        printProgress(name, copied, size)
+
+def printProgress(name, copied, total):
+    if total >= PROGRESS_MIN_SIZE and sys.stderr.isatty():
+        print(f'\r{name}: {copied * 100 // total:3d}% of {total // (1024 * 1024)} MB', end='' if copied < total else '\n', file=sys.stderr, flush=True)
+
+# folder -> True if the file system distinguishes names that differ only in case, see isCaseSensitiveFolder()
+caseSensitiveFolders = {}
+
+def isCaseSensitiveFolder(path):
+    """Return True if the folder of the existing file path is case sensitive. The result is cached per folder.
+    
+    The folder is case insensitive if the name of path with swapped case refers to the same file. 
+    Return False if this cannot be checked, e.g. the name has no letters: renaming via a temp name works always.
+    """
+    folder = path.parent
+    key = pathKey(folder)
+    sensitive = caseSensitiveFolders.get(key)
+    if sensitive is None:
+        swappedName = path.name.swapcase()
+        if swappedName == path.name or swappedName.swapcase() != path.name:
+            return False
+        stat = os.lstat(path)
+        try:
+            sensitive = not os.path.samestat(stat, os.lstat(folder / swappedName))
+        except FileNotFoundError:
+            sensitive = True
+        logging.debug('Case sensitive folder %s: %s', folder, sensitive)
+        caseSensitiveFolders[key] = sensitive
+    return sensitive
+
+def getTempPath(path, fs=None):
+    """Return a random path in the same folder: "path" -> "path.<RANDOM>". It does not exist in the given 
+    DryRunFileSystem, a real move must not overwrite it (see moveNoReplace())."""
+    while True:
+        randomPostfix = ''.join(random.choices(string.ascii_uppercase + string.digits, k=5))
+        tmpPath = Path(str(path) + f'.{randomPostfix}')
+        if fs is None or not fs.exists(tmpPath):
+            return tmpPath
+
 def getPaths(tops, dirOnly, args):
-    """Returns all files and folders."""
-    paths = []
+    """Returns all files and folders as dict: path -> DirEntry or stat result."""
+    paths = {}
+    for batch in iterPathBatches(tops, dirOnly, args):
+        # remove duplicates
+        paths.update(batch)
+    return paths
+
+def iterPathBatches(tops, dirOnly, args):
+    """Yields all files and folders in sorted batches, one batch per folder. 
+    Each item is a tuple (path, DirEntry or stat result)."""
+    topStats = {}
     for top in tops:
-        if not os.path.exists(top):
+        try:
+            topStats[os.path.abspath(top)] = os.stat(top)
+        except FileNotFoundError:
             raise RenameError(f'Error: File "{top}" does not exist')
-        top = os.path.abspath(top)
-        if os.path.isdir(top):
+    pathFilter = PathFilter(args)
+    for top, topStat in topStats.items():
+        batch = []
+        if S_ISDIR(topStat.st_mode):
             if args.recursive:
-                for (root, dirs, files) in os.walk(top):
-                    if dirOnly:
-                        for d in dirs:
-                            d = os.path.join(root, d)
-                            paths.append(d)
-                    else:
-                        for f in files:
-                            f = os.path.join(root, f)
-                            paths.append(f)
+                for (root, dirs, files) in walkFolders(top, pathFilter):
+                    entries = dirs if dirOnly else files
+                    batch = [ (e.path, e) for e in entries if not pathFilter.isExcluded(e.path) ]
+                    if batch:
+                        yield sorted(batch, key=lambda item: item[0])
+                continue
             elif dirOnly:
-                paths.append(top)
+                batch.append((top, topStat))
             else:
-                for f in os.listdir(top):
-                    f = os.path.join(top, f)
-                    if not os.path.isdir(f):
-                        paths.append(f)
+                with os.scandir(top) as it:
+                    for entry in it:
+                        if not entry.is_dir():
+                            batch.append((entry.path, entry))
         elif not dirOnly:
-            paths.append(top)
-    # remove duplicates
-    paths = set(paths)
-    # check exclude/include
-    if args.excludeList:
-        remainingPaths = []
-        for p in paths:
-            doAppend = True
-            # check excludes
-            for exclude in args.excludeList:
-                if fnmatch.fnmatch(p, exclude):
-                    doAppend = False
-                    # check includes
-                    for include in args.includeList:
-                        if fnmatch.fnmatch(p, include):
-                            doAppend = True
-                            break
-                    logging.debug(f'Include "{p}"' if doAppend else f'Exclude "{p}"')
-                    break
+            batch.append((top, topStat))
+        batch = [ item for item in batch if not pathFilter.isExcluded(item[0]) ]
+        if batch:
+            yield sorted(batch, key=lambda item: item[0])
 
-            if doAppend:
-                remainingPaths.append(p)
-        return remainingPaths
-    return paths
+def walkFolders(top, pathFilter):
+    """Walks the folder tree like os.walk (top-down, symbolic links are not followed) but yields DirEntry objects 
+    instead of names. Folders whose content is excluded completely are not entered at all."""
+    stack = [ top ]
+    while stack:
+        folder = stack.pop()
+        dirs = []
+        files = []
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    try:
+                        isDir = entry.is_dir()
+                    except OSError:
+                        isDir = False
+                    if isDir:
+                        dirs.append(entry)
+                    else:
+                        files.append(entry)
+        except OSError as e:
+            # ignore unreadable folders like os.walk
+            logging.debug(e)
+            continue
+        yield folder, dirs, files
+        # push in reverse order to walk the folders in the same order as os.walk
+        for entry in reversed(dirs):
+            if entry.is_symlink():
+                continue
+            if pathFilter.isPruned(entry.path):
+                logging.debug('Skip folder "%s"', entry.path)
+                continue
+            stack.append(entry.path)
+
+class PathMatcher:
+    """Matches a path against a list of fnmatch patterns with a single test per path. 
+    Patterns without wildcards, prefix-only ("abc*") and suffix-only ("*.mp3") patterns are checked with string 
+    operations, all other patterns are compiled into one regex."""
+    def __init__(self, patterns):
+        literals = set()
+        prefixes = []
+        suffixes = []
+        regexParts = []
+        for pattern in patterns:
+            # same as fnmatch.fnmatch()
+            pattern = os.path.normcase(pattern)
+            if not PathMatcher._hasWildcard(pattern):
+                literals.add(pattern)
+            elif pattern.endswith('*') and not PathMatcher._hasWildcard(pattern[:-1]):
+                prefixes.append(pattern[:-1])
+            elif pattern.startswith('*') and not PathMatcher._hasWildcard(pattern[1:]):
+                suffixes.append(pattern[1:])
+            else:
+                regexParts.append(fnmatch.translate(pattern))
+        self.literals = literals
+        self.prefixes = tuple(prefixes)
+        self.suffixes = tuple(suffixes)
+        self.regex = re.compile('|'.join(f'(?:{r})' for r in regexParts)) if regexParts else None
+
+    @staticmethod
+    def _hasWildcard(pattern):
+        return '*' in pattern or '?' in pattern or '[' in pattern
+
+    def matches(self, path):
+        path = os.path.normcase(path)
+        if path in self.literals or path.startswith(self.prefixes) or path.endswith(self.suffixes):
+            return True
+        return self.regex is not None and self.regex.match(path) is not None
+
+class PathFilter:
+    """Handler for options --exclude and --include."""
+    def __init__(self, args):
+        self.excludeMatcher = PathMatcher(args.excludeList) if args.excludeList else None
+        self.includeMatcher = PathMatcher(args.includeList)
+        # A pattern like "*/.git/*" matches all paths in a folder if the folder path plus separator matches 
+        # the pattern without the trailing "*". Include patterns could match any path, so nothing is pruned if they are used.
+        prunePatterns = [ exclude[:-1] for exclude in args.excludeList if exclude.endswith('*') ] if not args.includeList else []
+        self.pruneMatcher = PathMatcher(prunePatterns) if prunePatterns else None
+        # files written by the run itself (--journal, --plan) are never renamed, the name is compared before the resolved path
+        ownFiles = [ file for file in (args.journal, args.planFile) if file ]
+        self.ownFileNames = set(os.path.normcase(os.path.basename(file)) for file in ownFiles)
+        self.ownFileKeys = set(pathKey(os.path.realpath(file)) for file in ownFiles)
+
+    def isExcluded(self, path):
+        """Check --exclude/--include and the files written by the run for the given path."""
+        if self.ownFileNames and os.path.normcase(os.path.basename(path)) in self.ownFileNames and pathKey(os.path.realpath(path)) in self.ownFileKeys:
+            logging.debug('Exclude own file "%s"', path)
+            return True
+        if self.excludeMatcher is None or not self.excludeMatcher.matches(path):
+            return False
+        if self.includeMatcher.matches(path):
+            logging.debug('Include "%s"', path)
+            return False
+        logging.debug('Exclude "%s"', path)
+        return True
+
+    def isPruned(self, folder):
+        """Check if the content of the given folder is excluded completely."""
+        return self.pruneMatcher is not None and self.pruneMatcher.matches(folder + os.sep)
+
+def getTemplates(args):
+    """Return the texts with placeholders used by the command."""
+    if args.command in (CMD_ADD, CMD_REPLACE):
+        return [ args.text ]
+    elif args.command == CMD_NUMBER:
+        return [ t for t in (args.before, args.after) if t ]
+    elif args.command == CMD_DIR:
+        return [ args.dir ]
+    return []
+
+def prefetchMetadata(renamers, args):
+    """Read the audio metadata of all files in a thread pool if the command uses audio placeholders. 
+    Otherwise the metadata would be read one file after another while the command is applied."""
+    if not SUPPORT_MUTAGEN:
+        return
+    placeholders = set(t.value for template in getTemplates(args) for t in textparser.tokenize(template, sep='|', includeSep=True) if t.isPlaceholder())
+    if placeholders.isdisjoint(AUDIO_PLACEHOLDERS):
+        return
+    audioRenamers = [ r for r in renamers if r.hasAudioMetadata() and r.getFirstTokenToChange() is not None ]
+    if not audioRenamers:
+        return
+    def load(renamer):
+        try:
+            renamer._audioMetadata
+        except Exception as e:
+            # the error is raised again when the placeholder is resolved
+            logging.debug('Failed to read metadata of "%s": %s', renamer.path, e)
+    logging.debug(f'Prefetch audio metadata for {len(audioRenamers)} files')
+    with ThreadPoolExecutor(max_workers=args.jobs if args.jobs > 1 else None) as executor:
+        for _ in executor.map(load, audioRenamers):
+            pass
+
+def createRenamers(files, parser, metadataCache, args, skipPathKeys=None):
+    """Create a FileRenamer for each tuple (path, DirEntry or stat result) unless the key of the resolved path is in skipPathKeys."""
+    renamers = []
+    for file, entry in files:
+        # same as Path.resolve() without an additional stat call
+        path = Path(os.path.realpath(file))
+        if skipPathKeys and pathKey(path) in skipPathKeys:
+            continue
+        tokens = parser.getTokens(path, args)
+        renamer = FileRenamer(path, tokens, metadataCache, entry)
+        renamers.append(renamer)
+    return renamers
+
+def printFailures(renamers):
+    """Print all files that could not be renamed and return True if there are any."""
+    failed = False
+    for f in renamers:
+        if not f.done:
+            print(f'{ANSI_RED}{f.getSrcFile()}: Renaming failed to {f.getDstFile()}{ANSI_END}')
+            failed = True
+    return failed
+
+def renameStream(parser, fs, metadataCache, args, journal=None, skipPathKeys=(), folderSync=None, plan=None):
+    """Enumerate, plan and rename folder by folder so that memory does not grow with the whole tree.
+    Only supported for STATELESS_COMMANDS. Files with a key in skipPathKeys are not renamed. With a RenamePlan, 
+    the renames are written to it instead. Return True if renaming failed for any file."""
+    profiler = parser.profiler
+    command = getCommand(args, None, parser)
+    failed = False
+    # files moved to another folder could be enumerated again if this folder is walked later, keys of resolved paths
+    movedPathKeys = set(skipPathKeys)
+    # folders that exist or were created by a previous batch
+    knownFolders = set()
+    for batch in profiler.iterate('enumeration', iterPathBatches(args.file, args.dirOnly, args)):
+        renamers = createRenamers(batch, parser, metadataCache, args, movedPathKeys)
+        with profiler.measure('metadata prefetch'):
+            prefetchMetadata(renamers, args)
+        with profiler.measure('command', len(renamers)):
+            for renamer in renamers:
+                command(renamer, args)
+                renamer.freeze()
+        if plan is not None:
+            with profiler.measure('plan', len(renamers)):
+                plan.write(renamers)
+            continue
+        with profiler.measure('rename', len(renamers)):
+            if journal is not None:
+                journal.writePlan(renamers)
+            RenameScheduler(renamers, fs, knownFolders, journal, folderSync).run(args)
+        with profiler.measure('output'):
+            failed |= printFailures(renamers)
+        for renamer in renamers:
+            dstPath = renamer.getDstPath()
+            if renamer.done and pathKey(dstPath.parent) != pathKey(renamer.path.parent):
+                movedPathKeys.add(renamer.getDstKey())
+    return failed
+
+def openJournal(argv, fs, folderSync, args):
+    """Open the journal of option --journal. With --resume, the renames planned by the interrupted run are finished first. 
+    Return the journal (None for a dry run), the keys of the paths planned by the interrupted run (None if there are none) 
+    and True if renaming failed for any file."""
+    if not args.resume:
+        if os.path.exists(args.journal) and os.path.getsize(args.journal):
+            raise RenameError(f'Error: Journal "{args.journal}" exists, use --resume to finish its run')
+        if fs is not None:
+            return None, None, False
+        journal = RenameJournal(args.journal)
+        journal.writeRun(argv)
+        return journal, None, False
+
+    content = JournalContent(args.journal)
+    if content.argv != argv or content.cwd != os.getcwd():
+        raise RenameError(f'Error: Journal "{args.journal}" was written by another command: {" ".join(content.argv)} (in {content.cwd})')
+    if content.undoneIds:
+        raise RenameError(f'Error: Journal "{args.journal}" was undone')
+    if content.ended:
+        raise RenameError(f'Error: Journal "{args.journal}" contains a finished run')
+    journal = RenameJournal(args.journal, content.nextId, content.size) if fs is None else None
+    # the file system only shows the result of an interrupted move until the next move
+    for move in content.moves:
+        if move['done'] is None:
+            done = content.isDone(move)
+            if journal is not None:
+                journal.writeResult(move['id'], done)
+    if not content.plan:
+        # interrupted before any file was moved
+        return journal, None, False
+
+    # follow the moves that were done to find the current path of each planned file
+    indexByPath = { src: i for i, (src, dst) in enumerate(content.plan) }
+    currentPaths = [ src for src, dst in content.plan ]
+    for move in content.moves:
+        if content.isDone(move):
+            i = indexByPath.pop(move['src'], None)
+            if i is not None:
+                currentPaths[i] = move['dst']
+                indexByPath[move['dst']] = i
+    renamers = []
+    for (src, dst), currentPath in zip(content.plan, currentPaths):
+        if currentPath == dst:
+            continue
+        renamer = createPlannedRenamer(src, dst)
+        if currentPath != src:
+            renamer.tmpPath = Path(currentPath)
+        renamers.append(renamer)
+    logging.debug(f'Resume {len(renamers)} of {len(content.plan)} planned renames')
+    RenameScheduler(renamers, fs, journal=journal, folderSync=folderSync).run(args)
+    failed = printFailures(renamers)
+    plannedPathKeys = set(pathKey(path) for paths in content.plan for path in paths)
+    return journal, plannedPathKeys, failed
+
+def createPlannedRenamer(src, dst):
+    """Create a FileRenamer for a rename that was computed before, without parsing the file name."""
+    path = Path(src)
+    renamer = FileRenamer(path, [ FilenameToken(path.name, False) ])
+    renamer.freeze(Path(dst))
+    return renamer
+
+def applyPlan(file, fs, journal, folderSync, skipPathKeys, args):
+    """Rename the files of the plan file (see RenamePlan) batch by batch. Files that were changed since 
+    planning are not renamed. Return True if renaming failed for any file."""
+    failed = False
+    knownFolders = set()
+    for records in RenamePlan.read(file):
+        renamers = []
+        for record in records:
+            src = record['src']
+            if pathKey(src) in skipPathKeys:
+                continue
+            try:
+                stat = os.stat(src)
+                changed = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns) != (record['dev'], record['ino'], record['size'], record['mtime'])
+            except FileNotFoundError:
+                changed = True
+            if changed:
+                print(f'{ANSI_RED}{relativeToCwd(Path(src))}: File was changed or removed since planning{ANSI_END}')
+                failed = True
+                continue
+            renamers.append(createPlannedRenamer(src, record['dst']))
+        if journal is not None:
+            journal.writePlan(renamers)
+        RenameScheduler(renamers, fs, knownFolders, journal, folderSync).run(args)
+        failed |= printFailures(renamers)
+    return failed
+
+def undoJournal(file, fs, folderSync, args):
+    """Move the files back in the reverse order of the moves recorded in the journal file and remove the 
+    folders created by the run. Return True if any file could not be moved back."""
+    content = JournalContent(file)
+    moves = [ m for m in content.moves if m['id'] not in content.undoneIds and content.isDone(m) ]
+    journal = RenameJournal(file, content.nextId, content.size) if fs is None else None
+    failed = False
+    try:
+        for move in reversed(moves):
+            src = Path(move['dst'])
+            dst = Path(move['src'])
+            if fs:
+                if fs.exists(dst):
+                    print(f'{ANSI_RED}{relativeToCwd(src)}: Moving back failed to {relativeToCwd(dst)}{ANSI_END}')
+                    failed = True
+                    continue
+                fs.move(src, dst)
+                print(f'{relativeToCwd(src)} -> {relativeToCwd(dst)}')
+                continue
+            try:
+                moveNoReplace(src, dst)
+            except (FileExistsError, FileNotFoundError) as e:
+                logging.debug('Move back failed: %s', e)
+                print(f'{ANSI_RED}{relativeToCwd(src)}: Moving back failed to {relativeToCwd(dst)}{ANSI_END}')
+                failed = True
+                continue
+            journal.writeUndo(move['id'])
+            if folderSync is not None:
+                folderSync.add((src.parent, dst.parent))
+            print(f'{relativeToCwd(src)} -> {relativeToCwd(dst)}') if args.verbose else logging.debug('%s -> %s', src, dst)
+        if fs is None:
+            # children were created after their parents, folders that are not empty are kept
+            for folder in reversed(content.folders):
+                try:
+                    os.rmdir(folder)
+                    if folderSync is not None:
+                        folderSync.add((Path(folder).parent,), renames=0)
+                except OSError as e:
+                    logging.debug('Folder not removed: %s', e)
+    finally:
+        if journal is not None:
+            journal.close()
+    return failed
 
 def positiveInt(value):
     """Check if value is positive int."""
@@ -876,228 +2165,280 @@ def nonEmptyString(value):
         raise argparse.ArgumentTypeError(f'invalid non-empty text: {value}')
     return value
     
-def main(argv=None):
-    try:
-        PROG_DESC = """\
-            Batch renaming of files.
-            
-            The general structure of a command is as follows:
-            > rename.py SELECT-OPTIONS COMMAND COMMAND-ARGUMENTS FILES
-            
-            SELECT-OPTIONS              : Define what to change (which parts of a file name).
-            COMMAND COMMAND-ARGUMENTS   : Define how to change (e.g. add a text).
-            FILES                       : Define the files that should be renamed. Default is to use the current directory.
-
-            The order of the select options is as follows: 
-            1. basename/ext 
-            2. index 
-            3. text 
-            4. char 
-            5. pattern.
-
-            === Select by pattern ===
-            
-            The --pattern option allows to group a file name. To do this, define placeholders in the following form: 
-            |NAME| or |NAME[:ATTR ...]|
-                
-            NAME the alphanumeric name of the placeholder. It can then be used in the command.
-            ATTR is used to change the behavior of the placeholder. The following possibilities exist:
-                ?   : placeholder does not behave greedily (default behavior is greedy)
-                s   : select this token (default is to select the whole pattern text)
-                a   : matches alphabets a-zA-Z (default is to match any character: .)
-                n   : matches numbers 0-9 (default is to match any character: .)
-                1-9 : number of characters to be read in (default is 0 or more: *)
-            
-            Example for file "20180122-description-long.jpg": --pattern "|Y:4:n||M:2||D:2|-|A:s:?|-|B|" 
-                |Y| = 2018 (4 numbers)
-                |M| = 01
-                |D| = 22
-                |A| = description (selected, not greedy)
-                |B| = long.jpg
-            
-            === Command test ===
-            
-            The test command allows to check which parts of the name are selected. The -p option prints the available placeholders for each file.
-            This can be very helpful to try out the various options without risk.
+def createArgumentParser():
+    """Create the parser for the command line arguments."""
+    PROG_DESC = """\
+        Batch renaming of files.
+        
+        The general structure of a command is as follows:
+        > rename.py SELECT-OPTIONS COMMAND COMMAND-ARGUMENTS FILES
+        
+        SELECT-OPTIONS              : Define what to change (which parts of a file name).
+        COMMAND COMMAND-ARGUMENTS   : Define how to change (e.g. add a text).
+        FILES                       : Define the files that should be renamed. Default is to use the current directory.
+
+        The order of the select options is as follows: 
+        1. basename/ext 
+        2. index 
+        3. text 
+        4. char 
+        5. pattern.
+
+        === Select by pattern ===
+        
+        The --pattern option allows to group a file name. To do this, define placeholders in the following form: 
+        |NAME| or |NAME[:ATTR ...]|
             
-            """
+        NAME the alphanumeric name of the placeholder. It can then be used in the command.
+        ATTR is used to change the behavior of the placeholder. The following possibilities exist:
+            ?   : placeholder does not behave greedily (default behavior is greedy)
+            s   : select this token (default is to select the whole pattern text)
+            a   : matches alphabets a-zA-Z (default is to match any character: .)
+            n   : matches numbers 0-9 (default is to match any character: .)
+            1-9 : number of characters to be read in (default is 0 or more: *)
         
-        parser = argparse.ArgumentParser(description=dedent(PROG_DESC), formatter_class=argparse.RawTextHelpFormatter)
-        parser.add_argument('--debug', help='activate DEBUG logging', action='store_true')
-        parser.add_argument('-v', '--verbose', action='store_true', help='explain what is being done')
-        parser.add_argument('-n', '--dry-run', action='store_true', dest='simulate', help='simulate backup process')
-        parser.add_argument('-r', '--recursive', action='store_true', help='perform command recursively')
-        parser.add_argument('--dir-only', action='store_true', dest='dirOnly', help='rename folders only')
-        parser.add_argument('--exclude', action='append', dest='excludeList', default=[], help='exclude file/folder matching full path pattern')
-        parser.add_argument('--include', action='append', dest='includeList', default=[], help='do not exclude file/folder matching full path pattern')
-        # basename/ext
-        group_1 = parser.add_argument_group('1. Select the part of a filename to change (<basename>.<ext>)')
-        group_1 = group_1.add_mutually_exclusive_group()
-        group_1.add_argument('-b', action='store_true', dest='basename', help='select basename to change')
-        group_1.add_argument('-e', action='store_true', dest='ext', help='select extension to change without dot')
-        group_1.add_argument('-E', action='store_true', dest='extWithDot', help='change extension only with dot')
-        # index
-        group_2 = parser.add_argument_group('2. Select text to change either by single index (--index) or range index (--index*)')
-        group_2.add_argument('--index', dest='selectIndex', type=positiveInt, help='select single character to change by index from the left')
-        group_2.add_argument('--index-from', dest='selectIndexFrom', type=positiveInt, help='select text to change by start index from the left')
-        group_2.add_argument('--index-to', dest='selectIndexTo', type=positiveInt, help='select text to change by end index from the left')
-        group_2.add_argument('--indexr-from', dest='selectIndexRightFrom', type=positiveInt, help='select text to change by start index from the right')
-        group_2.add_argument('--indexr-to', dest='selectIndexRightTo', type=positiveInt, help='select text to change by end index from the right')
-        # text
-        group_3 = parser.add_argument_group('3. Select text to change either by text (--text) or text ranges (--text*)')
-        group_3.add_argument('--text', dest='selectText', type=nonEmptyString, help='select matching text to change')
-        group_3.add_argument('--text-from', dest='selectTextFrom', type=nonEmptyString, help='select text to change by start index from the left')
-        group_3.add_argument('--text-to', dest='selectTextTo', type=nonEmptyString, help='select text to change by end index from the left')
-        group_3.add_argument('--textx-from', dest='selectTextExclFrom', type=nonEmptyString, help='select text to change by start index from the left')
-        group_3.add_argument('--textx-to', dest='selectTextExclTo', type=nonEmptyString, help='select text to change by start index from the left')
-        # char
-        group_4 = parser.add_argument_group('4. Select text to change by character type')
-        group_4 = group_4.add_mutually_exclusive_group()
-        group_4.add_argument('--char-num', action='store_true', dest='charNum', help='select only numberics to change')
-        group_4.add_argument('--char-non-num', action='store_true', dest='charNonNum', help='select all except numerics to change')
-        group_4.add_argument('--char-alpha', action='store_true', dest='charAlpha', help='select only alphabets to change')
-        group_4.add_argument('--char-non-alpha', action='store_true', dest='charNonAlpha', help='select all except alphabets to change')
-        group_4.add_argument('--char-alnum', action='store_true', dest='charAlnum', help='select only alphanumerics to change')
-        group_4.add_argument('--char-non-alnum', action='store_true', dest='charNonAlnum', help='select all except alphanumerics to change')
-        group_4.add_argument('--char-upper', action='store_true', dest='charUpper', help='select upper case alphabets to change (A-Z)')
-        group_4.add_argument('--char-lower', action='store_true', dest='charLower', help='select upper case alphabets to change (a-z)')
-        # pattern
-        group_5 = parser.add_argument_group('5. Select text to change by pattern')
-        group_5.add_argument('--pattern', help='the pattern to parse')
-
-        subparsers = parser.add_subparsers(dest='command')
-        subparsers.required = True
-        # test
-        testParser = subparsers.add_parser(CMD_TEST, help='print selected text and exit')
-        testParser.add_argument('-a', '--all', action='store_true', dest='showAll', help='show all files')
-        testParser.add_argument('-p', action='store_true', dest='showPlaceholders', help='show placeholders')
-        testParser.add_argument('file', nargs='*', default='.', help='file or folder')
-        # add
-        addParser = subparsers.add_parser(CMD_ADD, help='add text before/after selected text: cd -> ABcd')
-        addParser.add_argument('-e', action='store_true', dest='end', help='add TEXT at the end')
-        addParser.add_argument('text', help='the text to add')
-        addParser.add_argument('file', nargs='*', default='.', help='file or folder')
-        # remove
-        removeParser = subparsers.add_parser(CMD_REMOVE, help='remove selected text: ABcd -> cd')
-        removeParser.add_argument('file', nargs='*', default='.', help='file or folder')
-        # replace
-        replaceParser = subparsers.add_parser(CMD_REPLACE, help='replace selected text: ABcd -> EFcd')
-        replaceParser.add_argument('text', help='the text to use')
-        replaceParser.add_argument('file', nargs='*', default='.', help='file or folder')
-        # lower
-        lowerParser = subparsers.add_parser(CMD_LOWERCASE, help='change selected text to lower case: Ab -> ab')
-        lowerParser.add_argument('file', nargs='*', default='.', help='file or folder')
-        # upper
-        upperParser = subparsers.add_parser(CMD_UPPERCASE, help='change selected text to UPPER CASE: ab -> AB')
-        upperParser.add_argument('file', nargs='*', default='.', help='file or folder')
-        # camel
-        camelParser = subparsers.add_parser(CMD_CAMELCASE, help='change selected text to Camel Case: ab cd -> Ab Cd')
-        camelParser.add_argument('file', nargs='*', default='.', help='file or folder')
-        # sentence
-        sentenceParser = subparsers.add_parser(CMD_SENTENCECASE, help='change selected text to Sentence case: ab cd -> Ab cd')
-        sentenceParser.add_argument('file', nargs='*', default='.', help='file or folder')
-        # fill
-        fillParser = subparsers.add_parser(CMD_FILL, help='Fill the selected text with CHAR until they have the same width: 1, 100 -> 001, 100')
-        fillParser.add_argument('-w', dest='width', type=int, help='set the width of the text')
-        fillParser.add_argument('-e', action='store_true', dest='end', help='add TEXT at the end')
-        fillParser.add_argument('char', help='the fill character')
-        fillParser.add_argument('file', nargs='*', default='.', help='file or folder')
-        # swap
-        swapParser = subparsers.add_parser(CMD_SWAP, help='swap selected text by separator: a_b -> b_a')
-        swapParser.add_argument('-l', '--left', action='store_true', dest='left', help='separator belongs to left part')
-        swapParser.add_argument('-r', '--right', action='store_true', dest='right', help='separator belongs to right part')
-        swapParser.add_argument('separator', help='the separator')
-        swapParser.add_argument('file', nargs='*', default='.', help='file or folder')
-        # number
-        numberParser = subparsers.add_parser(CMD_NUMBER, help='add numbering before/after selected text: a, b -> 01-a, 02-b')
-        numberParser.add_argument('-e', action='store_true', dest='end', help='add NUMBER at the end')
-        numberParser.add_argument('-b', dest='before', help='add TEXT before NUMBER')
-        numberParser.add_argument('-a', dest='after', help='add TEXT after NUMBER')
-        numberParser.add_argument('-w', dest='width', type=int, help='set the width of NUMBER, e.g. 2: 01,02,03 / 3: 001,002,003')
-        numberParser.add_argument('-s', '--start', dest='start', type=int, default=1, help='start index (default: 1)')
-        numberParser.add_argument('-i', '--increment', dest='increment', type=int, default=1, help='step size (default: 1)')
-        numberParser.add_argument('--replace', action='store_true', dest='replace', help='replace selected text')
-        numberParser.add_argument('--no-reset', action='store_true', dest='noReset', help='avoid restart for each folder')
-        numberParser.add_argument('file', nargs='*', default='.', help='file or folder')
-        # cut
-        cutParser = subparsers.add_parser(CMD_CUT, help='cut the selected text at the beginning/end: ABcd -> cd')
-        cutParser.add_argument('-e', action='store_true', dest='end', help='cut TEXT at the end')
-        cutParser.add_argument('index', type=int, help='number characters to cut')
-        cutParser.add_argument('file', nargs='*', default='.', help='file or folder')
-        # keep
-        keepParser = subparsers.add_parser(CMD_KEEP, help='keep the selected text at the beginning/end, rest will be deleted: abC, deFG -> ab, de')
-        keepParser.add_argument('-e', action='store_true', dest='end', help='keep TEXT at the end')
-        keepParser.add_argument('index', type=int, help='number characters to keep')
-        keepParser.add_argument('file', nargs='*', default='.', help='file or folder')
-        # dir
-        dirParser = subparsers.add_parser(CMD_DIR, help='move the matching files to DIR: abc -> dir/abc')
-        dirParser.add_argument('dir', help='the target directory')
-        dirParser.add_argument('file', nargs='*', default='.', help='file or folder')
+        Example for file "20180122-description-long.jpg": --pattern "|Y:4:n||M:2||D:2|-|A:s:?|-|B|" 
+            |Y| = 2018 (4 numbers)
+            |M| = 01
+            |D| = 22
+            |A| = description (selected, not greedy)
+            |B| = long.jpg
         
+        === Command test ===
+        
+        The test command allows to check which parts of the name are selected. The -p option prints the available placeholders for each file.
+        This can be very helpful to try out the various options without risk.
+        
+        """
+    
+    parser = argparse.ArgumentParser(description=dedent(PROG_DESC), formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--debug', help='activate DEBUG logging', action='store_true')
+    parser.add_argument('-v', '--verbose', action='store_true', help='explain what is being done')
+    parser.add_argument('-n', '--dry-run', action='store_true', dest='simulate', help='simulate backup process')
+    parser.add_argument('-r', '--recursive', action='store_true', help='perform command recursively')
+    parser.add_argument('--dir-only', action='store_true', dest='dirOnly', help='rename folders only')
+    parser.add_argument('--exclude', action='append', dest='excludeList', default=[], help='exclude file/folder matching full path pattern')
+    parser.add_argument('--include', action='append', dest='includeList', default=[], help='do not exclude file/folder matching full path pattern')
+    parser.add_argument('-j', '--jobs', type=positiveInt, default=1, help='number of renames to run in parallel, e.g. for network file systems (default: 1)')
+    parser.add_argument('--no-cache', action='store_true', dest='noCache', help='do not use the metadata cache (~/.cache/rename)')
+    parser.add_argument('--profile', action='store_true', help='print time and number of calls per phase')
+    parser.add_argument('--stream', action='store_true', help='rename folder by folder with bounded memory (files only, not for: fill, number, test)')
+    parser.add_argument('--journal', help='record all renames in this file to resume or undo the run')
+    parser.add_argument('--resume', action='store_true', help='finish the interrupted run recorded with --journal (same arguments without --resume)')
+    parser.add_argument('--durable', action='store_true', help='sync all changed folders to disk at the end so that the renames survive a power failure')
+    parser.add_argument('--sync-every', type=positiveInt, dest='syncEvery', help='with --durable, sync the changed folders also after every N renames')
+    parser.add_argument('--plan', dest='planFile', help='write the renames to this file instead of renaming, see command apply')
+    # basename/ext
+    group_1 = parser.add_argument_group('1. Select the part of a filename to change (<basename>.<ext>)')
+    group_1 = group_1.add_mutually_exclusive_group()
+    group_1.add_argument('-b', action='store_true', dest='basename', help='select basename to change')
+    group_1.add_argument('-e', action='store_true', dest='ext', help='select extension to change without dot')
+    group_1.add_argument('-E', action='store_true', dest='extWithDot', help='change extension only with dot')
+    # index
+    group_2 = parser.add_argument_group('2. Select text to change either by single index (--index) or range index (--index*)')
+    group_2.add_argument('--index', dest='selectIndex', type=positiveInt, help='select single character to change by index from the left')
+    group_2.add_argument('--index-from', dest='selectIndexFrom', type=positiveInt, help='select text to change by start index from the left')
+    group_2.add_argument('--index-to', dest='selectIndexTo', type=positiveInt, help='select text to change by end index from the left')
+    group_2.add_argument('--indexr-from', dest='selectIndexRightFrom', type=positiveInt, help='select text to change by start index from the right')
+    group_2.add_argument('--indexr-to', dest='selectIndexRightTo', type=positiveInt, help='select text to change by end index from the right')
+    # text
+    group_3 = parser.add_argument_group('3. Select text to change either by text (--text) or text ranges (--text*)')
+    group_3.add_argument('--text', dest='selectText', type=nonEmptyString, help='select matching text to change')
+    group_3.add_argument('--text-from', dest='selectTextFrom', type=nonEmptyString, help='select text to change by start index from the left')
+    group_3.add_argument('--text-to', dest='selectTextTo', type=nonEmptyString, help='select text to change by end index from the left')
+    group_3.add_argument('--textx-from', dest='selectTextExclFrom', type=nonEmptyString, help='select text to change by start index from the left')
+    group_3.add_argument('--textx-to', dest='selectTextExclTo', type=nonEmptyString, help='select text to change by start index from the left')
+    # char
+    group_4 = parser.add_argument_group('4. Select text to change by character type')
+    group_4 = group_4.add_mutually_exclusive_group()
+    group_4.add_argument('--char-num', action='store_true', dest='charNum', help='select only numberics to change')
+    group_4.add_argument('--char-non-num', action='store_true', dest='charNonNum', help='select all except numerics to change')
+    group_4.add_argument('--char-alpha', action='store_true', dest='charAlpha', help='select only alphabets to change')
+    group_4.add_argument('--char-non-alpha', action='store_true', dest='charNonAlpha', help='select all except alphabets to change')
+    group_4.add_argument('--char-alnum', action='store_true', dest='charAlnum', help='select only alphanumerics to change')
+    group_4.add_argument('--char-non-alnum', action='store_true', dest='charNonAlnum', help='select all except alphanumerics to change')
+    group_4.add_argument('--char-upper', action='store_true', dest='charUpper', help='select upper case alphabets to change (A-Z)')
+    group_4.add_argument('--char-lower', action='store_true', dest='charLower', help='select upper case alphabets to change (a-z)')
+    # pattern
+    group_5 = parser.add_argument_group('5. Select text to change by pattern')
+    group_5.add_argument('--pattern', help='the pattern to parse')
+
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    # test
+    testParser = subparsers.add_parser(CMD_TEST, help='print selected text and exit')
+    testParser.add_argument('-a', '--all', action='store_true', dest='showAll', help='show all files')
+    testParser.add_argument('-p', action='store_true', dest='showPlaceholders', help='show placeholders')
+    testParser.add_argument('file', nargs='*', default='.', help='file or folder')
+    # add
+    addParser = subparsers.add_parser(CMD_ADD, help='add text before/after selected text: cd -> ABcd')
+    addParser.add_argument('-e', action='store_true', dest='end', help='add TEXT at the end')
+    addParser.add_argument('text', help='the text to add')
+    addParser.add_argument('file', nargs='*', default='.', help='file or folder')
+    # remove
+    removeParser = subparsers.add_parser(CMD_REMOVE, help='remove selected text: ABcd -> cd')
+    removeParser.add_argument('file', nargs='*', default='.', help='file or folder')
+    # replace
+    replaceParser = subparsers.add_parser(CMD_REPLACE, help='replace selected text: ABcd -> EFcd')
+    replaceParser.add_argument('text', help='the text to use')
+    replaceParser.add_argument('file', nargs='*', default='.', help='file or folder')
+    # lower
+    lowerParser = subparsers.add_parser(CMD_LOWERCASE, help='change selected text to lower case: Ab -> ab')
+    lowerParser.add_argument('file', nargs='*', default='.', help='file or folder')
+    # upper
+    upperParser = subparsers.add_parser(CMD_UPPERCASE, help='change selected text to UPPER CASE: ab -> AB')
+    upperParser.add_argument('file', nargs='*', default='.', help='file or folder')
+    # camel
+    camelParser = subparsers.add_parser(CMD_CAMELCASE, help='change selected text to Camel Case: ab cd -> Ab Cd')
+    camelParser.add_argument('file', nargs='*', default='.', help='file or folder')
+    # sentence
+    sentenceParser = subparsers.add_parser(CMD_SENTENCECASE, help='change selected text to Sentence case: ab cd -> Ab cd')
+    sentenceParser.add_argument('file', nargs='*', default='.', help='file or folder')
+    # fill
+    fillParser = subparsers.add_parser(CMD_FILL, help='Fill the selected text with CHAR until they have the same width: 1, 100 -> 001, 100')
+    fillParser.add_argument('-w', dest='width', type=int, help='set the width of the text')
+    fillParser.add_argument('-e', action='store_true', dest='end', help='add TEXT at the end')
+    fillParser.add_argument('char', help='the fill character')
+    fillParser.add_argument('file', nargs='*', default='.', help='file or folder')
+    # swap
+    swapParser = subparsers.add_parser(CMD_SWAP, help='swap selected text by separator: a_b -> b_a')
+    swapParser.add_argument('-l', '--left', action='store_true', dest='left', help='separator belongs to left part')
+    swapParser.add_argument('-r', '--right', action='store_true', dest='right', help='separator belongs to right part')
+    swapParser.add_argument('separator', help='the separator')
+    swapParser.add_argument('file', nargs='*', default='.', help='file or folder')
+    # number
+    numberParser = subparsers.add_parser(CMD_NUMBER, help='add numbering before/after selected text: a, b -> 01-a, 02-b')
+    numberParser.add_argument('-e', action='store_true', dest='end', help='add NUMBER at the end')
+    numberParser.add_argument('-b', dest='before', help='add TEXT before NUMBER')
+    numberParser.add_argument('-a', dest='after', help='add TEXT after NUMBER')
+    numberParser.add_argument('-w', dest='width', type=int, help='set the width of NUMBER, e.g. 2: 01,02,03 / 3: 001,002,003')
+    numberParser.add_argument('-s', '--start', dest='start', type=int, default=1, help='start index (default: 1)')
+    numberParser.add_argument('-i', '--increment', dest='increment', type=int, default=1, help='step size (default: 1)')
+    numberParser.add_argument('--replace', action='store_true', dest='replace', help='replace selected text')
+    numberParser.add_argument('--no-reset', action='store_true', dest='noReset', help='avoid restart for each folder')
+    numberParser.add_argument('file', nargs='*', default='.', help='file or folder')
+    # cut
+    cutParser = subparsers.add_parser(CMD_CUT, help='cut the selected text at the beginning/end: ABcd -> cd')
+    cutParser.add_argument('-e', action='store_true', dest='end', help='cut TEXT at the end')
+    cutParser.add_argument('index', type=int, help='number characters to cut')
+    cutParser.add_argument('file', nargs='*', default='.', help='file or folder')
+    # keep
+    keepParser = subparsers.add_parser(CMD_KEEP, help='keep the selected text at the beginning/end, rest will be deleted: abC, deFG -> ab, de')
+    keepParser.add_argument('-e', action='store_true', dest='end', help='keep TEXT at the end')
+    keepParser.add_argument('index', type=int, help='number characters to keep')
+    keepParser.add_argument('file', nargs='*', default='.', help='file or folder')
+    # dir
+    dirParser = subparsers.add_parser(CMD_DIR, help='move the matching files to DIR: abc -> dir/abc')
+    dirParser.add_argument('dir', help='the target directory')
+    dirParser.add_argument('file', nargs='*', default='.', help='file or folder')
+    # undo
+    undoParser = subparsers.add_parser(CMD_UNDO, help='move the files back to the names before the run recorded with --journal')
+    undoParser.add_argument('journal', help='the journal file of the run')
+    # apply
+    applyParser = subparsers.add_parser(CMD_APPLY, help='rename the files as written by --plan, files changed since then are skipped')
+    applyParser.add_argument('plan', help='the plan file')
+    return parser
+
+def main(argv=None):
+    metadataCache = None
+    profiler = None
+    journal = None
+    folderSync = None
+    plan = None
+    completed = False
+    try:
+        argv = sys.argv[1:] if argv is None else list(argv)
+        parser = createArgumentParser()
         args = parser.parse_args(argv)
         
         # init logging
         level = logging.DEBUG if args.debug else logging.WARNING
         logging.basicConfig(format='%(levelname)s: %(message)s', level=level, force=True)
         
-        # get files
-        files = getPaths(args.file, args.dirOnly, args)
-        files = sorted(files)
-        
         # init parser
-        parser = FilenameParser()
+        profiler = Profiler(args.profile)
+        parser = FilenameParser(profiler)
         parser.init(args)
+        fs = DryRunFileSystem() if args.simulate else None
+        if args.durable and fs is None:
+            folderSync = FolderSync(args.syncEvery)
+
+        if args.syncEvery and not args.durable:
+            raise RenameError('Error: --sync-every requires --durable')
+        if args.planFile and (args.journal or args.command in (CMD_TEST, CMD_APPLY, CMD_UNDO)):
+            raise RenameError(f'Error: --plan cannot be used with --journal or the commands {CMD_TEST}, {CMD_APPLY}, {CMD_UNDO}')
+        if args.command == CMD_UNDO:
+            if undoJournal(args.journal, fs, folderSync, args) and not args.simulate:
+                exit(2)
+            return
+        if args.resume and not args.journal:
+            raise RenameError('Error: --resume requires --journal')
+
+        if SUPPORT_MUTAGEN and not args.noCache:
+            metadataCache = MetadataCache(MetadataCache.getDefaultFile())
+
+        stream = args.stream and args.command in STATELESS_COMMANDS and not args.dirOnly
+        if args.stream and not stream:
+            logging.debug(f'Streaming is not supported for command "{args.command}", use two phases')
+        plannedPathKeys = None
+        failed = False
+        if args.planFile:
+            plan = RenamePlan(args.planFile)
+            plan.writeRun(argv)
+        elif args.journal and args.command != CMD_TEST:
+            journal, plannedPathKeys, failed = openJournal([ a for a in argv if a != '--resume' ], fs, folderSync, args)
+
+        if args.command == CMD_APPLY:
+            failed |= applyPlan(args.plan, fs, journal, folderSync, plannedPathKeys or (), args)
+            completed = True
+            if failed and not args.simulate:
+                exit(2)
+            return
+        if stream:
+            failed |= renameStream(parser, fs, metadataCache, args, journal, plannedPathKeys or (), folderSync, plan)
+        if stream or plannedPathKeys is not None:
+            # the plan of a resumed run in two phases contains all files
+            completed = True
+            if failed and not args.simulate:
+                exit(2)
+            return
+
+        # get files
+        with profiler.measure('enumeration'):
+            files = getPaths(args.file, args.dirOnly, args)
+            files = sorted(files.items(), key=lambda item: item[0])
         
         # create renamer
-        renamers = []
-        for file in files:
-            path = Path(file).resolve()
-            tokens = parser.getTokens(path, args)
-            renamer = FileRenamer(path, tokens)
-            renamers.append(renamer)
+        renamers = createRenamers(files, parser, metadataCache, args)
+        with profiler.measure('metadata prefetch'):
+            prefetchMetadata(renamers, args)
         
-        command = getCommand(args, renamers)
-        for renamer in renamers:
-            command(renamer, args)
+        with profiler.measure('command', len(renamers)):
+            command = getCommand(args, renamers, parser)
+            for renamer in renamers:
+                command(renamer, args)
+                renamer.freeze()
 
         if args.command in (CMD_TEST):
             return
+        if plan is not None:
+            with profiler.measure('plan', len(renamers)):
+                plan.write(renamers)
+            completed = True
+            return
 
-        if args.simulate:
-            deletedFiles = []
-            createdFiles = []
-            while True:
-                fileRenamed = False
-                for f in renamers:
-                    fileRenamed |= f.renameDryRun(deletedFiles, createdFiles)
-                    if fileRenamed:
-                        deletedFiles.append(f.getSrcFile())
-                        createdFiles.append(f.getDstFile())
-                if not fileRenamed:
-                    break
+        # rename files
+        with profiler.measure('rename', len(renamers)):
+            if journal is not None:
+                journal.writePlan(renamers)
+            RenameScheduler(renamers, fs, journal=journal, folderSync=folderSync).run(args)
+        completed = True
 
-            # check if all files could be renamed
-            for f in renamers:
-                if not f.done:
-                    print(f'{ANSI_RED}{f.getSrcFile()}: Renaming failed to {f.getDstFile()}{ANSI_END}')
-        else:
-            # rename files
-            while True:
-                # repeat until no file could be renamed anymore
-                fileRenamed = False
-                for f in renamers:
-                    fileRenamed |= f.rename(args)
-                if not fileRenamed:
-                    break
-
-            # check if all files could be renamed
-            failed = False
-            for f in renamers:
-                if not f.done:
-                    print(f'{ANSI_RED}{f.getSrcFile()}: Renaming failed to {f.getDstFile()}{ANSI_END}')
-                    failed = True
-            if failed:
-                exit(2)
+        # check if all files could be renamed
+        with profiler.measure('output'):
+            failed |= printFailures(renamers)
+        if failed and not args.simulate:
+            exit(2)
 
     except Exception as e:
         print(e)
@@ -1105,6 +2446,23 @@ def main(argv=None):
         if args.debug:
             traceback.print_exc()
         exit(1)
+    finally:
+        if folderSync is not None:
+            # also for an interrupted run: the renames done so far are synced
+            with profiler.measure('sync'):
+                folderSync.sync()
+            folderSync.report()
+        if journal is not None:
+            # the end is recorded after the folders were synced, an interrupted run can be finished with --resume
+            journal.close(completed)
+        if plan is not None:
+            plan.close(completed)
+            if completed:
+                print(f'{plan.count} renames planned: {plan.file}')
+        if metadataCache is not None:
+            metadataCache.close()
+        if profiler is not None:
+            profiler.report()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import io
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+from contextlib import redirect_stdout
+from pathlib import Path
+
+# import from parent dir
+PROJECT_DIR = Path(__file__).absolute().parent
+sys.path.insert(0, PROJECT_DIR.parent.as_posix())
+import rename
+
+MP3_WITH_ID3_TAGS = PROJECT_DIR / 'mp3-with-tags.mp3'
+
+# Usage:
+# > benchmark_rename.py
+# > benchmark_rename.py --sizes 10000 100000 1000000 --layouts flat deep --output results.json
+# > benchmark_rename.py --output new.json --compare results.json
+
+EXTENSIONS = [ '.txt', '.jpg', '.JPG', '.tar.gz', '.mp4', '' ]
+# every n-th file is a copy of an mp3 file with ID3 tags
+MP3_EVERY = 100
+# number of files per folder for the deep layout
+FILES_PER_FOLDER = 100
+
+SELECTORS = {
+    'basename': [ '-b' ],
+    'ext': [ '-e' ],
+    'index-to': [ '--index-to', '4' ],
+    'index-range': [ '--index-from', '2', '--indexr-to', '3' ],
+    'text': [ '--text', '_' ],
+    'text-from': [ '--text-from', 'file' ],
+    'char-num': [ '--char-num' ],
+    'pattern': [ '--pattern', '|1|_|2|' ],
+}
+COMMANDS = {
+    rename.CMD_ADD: [ 'add', 'x_' ],
+    rename.CMD_REMOVE: [ 'remove' ],
+    rename.CMD_REPLACE: [ 'replace', '|b|-|f0|' ],
+    rename.CMD_LOWERCASE: [ 'lowercase' ],
+    rename.CMD_UPPERCASE: [ 'uppercase' ],
+    rename.CMD_CAMELCASE: [ 'camelcase' ],
+    rename.CMD_SENTENCECASE: [ 'sentencecase' ],
+    rename.CMD_SWAP: [ 'swap', '_' ],
+    rename.CMD_FILL: [ 'fill', '0' ],
+    rename.CMD_NUMBER: [ 'number', '-a', '-' ],
+    rename.CMD_CUT: [ 'cut', '2' ],
+    rename.CMD_KEEP: [ 'keep', '3' ],
+    rename.CMD_DIR: [ 'dir', '|m:yyyy|' ],
+}
+
+def createTree(root, size, layout):
+    """Create size files in root. Layout "flat" uses a single folder, "deep" uses three folder levels."""
+    mp3Data = MP3_WITH_ID3_TAGS.read_bytes()
+    for i in range(size):
+        if layout == 'deep':
+            folderNo = i // FILES_PER_FOLDER
+            folder = os.path.join(root, f'a{folderNo // 10000}', f'b{folderNo // 100 % 100}', f'c{folderNo % 100}')
+        else:
+            folder = root
+        if i % FILES_PER_FOLDER == 0:
+            os.makedirs(folder, exist_ok=True)
+        if i % MP3_EVERY == 0:
+            with open(os.path.join(folder, f'track_{i}.mp3'), 'wb') as f:
+                f.write(mp3Data)
+        else:
+            ext = EXTENSIONS[i % len(EXTENSIONS)]
+            open(os.path.join(folder, f'file_{i} Name{ext}'), 'x').close()
+
+def parseArgs(argv, root):
+    return rename.createArgumentParser().parse_args([ '--no-cache', '-r' ] + argv + [ root ])
+
+def measure(results, name, func):
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    results[name] = seconds
+    print(f'  {name:<30} {seconds:10.3f} s')
+
+def runQuiet(argv):
+    """Run rename.py without its output, which would dominate the time of a dry run."""
+    with redirect_stdout(io.StringIO()):
+        rename.main(argv)
+
+def getFiles(args):
+    return sorted(rename.getPaths(args.file, args.dirOnly, args).items(), key=lambda item: item[0])
+
+def runBenchmark(root, size, layout):
+    """Run all benchmarks for one tree and return the results as dict: name -> seconds."""
+    results = {}
+    print(f'Create {layout} tree with {size} files')
+    createTree(root, size, layout)
+
+    args = parseArgs([ 'test' ], root)
+    measure(results, 'getPaths', lambda: rename.getPaths(args.file, args.dirOnly, args))
+    files = getFiles(args)
+
+    # selectors
+    for name, selectorArgs in SELECTORS.items():
+        args = parseArgs(selectorArgs + [ 'test' ], root)
+        parser = rename.FilenameParser()
+        parser.init(args)
+        paths = [ Path(os.path.realpath(f)) for f, _ in files ]
+        def getTokens():
+            for path in paths:
+                parser.getTokens(path, args)
+        measure(results, f'getTokens {name}', getTokens)
+
+    # commands
+    for name, commandArgs in COMMANDS.items():
+        args = parseArgs([ '--text', '_' ] + commandArgs, root)
+        parser = rename.FilenameParser()
+        parser.init(args)
+        renamers = rename.createRenamers(files, parser, None, args)
+        def applyCommand():
+            command = rename.getCommand(args, renamers, parser)
+            for renamer in renamers:
+                command(renamer, args)
+        measure(results, f'command {name}', applyCommand)
+
+    # audio metadata
+    if rename.SUPPORT_MUTAGEN:
+        args = parseArgs([ '--include', '*.mp3', '--exclude', '*', '-b', 'replace', '|no| |artist|' ], root)
+        parser = rename.FilenameParser()
+        parser.init(args)
+        renamers = rename.createRenamers(getFiles(args), parser, None, args)
+        measure(results, 'metadata prefetch', lambda: rename.prefetchMetadata(renamers, args))
+
+    # rename
+    measure(results, 'dry run', lambda: runQuiet([ '--no-cache', '-n', '-r', 'add', 'x_', root ]))
+    measure(results, 'rename', lambda: runQuiet([ '--no-cache', '-r', 'add', 'x_', root ]))
+    return results
+
+def compare(results, baseline, threshold):
+    """Print all benchmarks that are slower than the baseline by more than threshold and return them."""
+    regressions = []
+    for tree, benchmarks in results.items():
+        for name, seconds in benchmarks.items():
+            before = baseline.get(tree, {}).get(name)
+            if before and seconds > before * threshold:
+                regressions.append((tree, name, before, seconds))
+                print(f'Regression {tree} / {name}: {before:.3f} s -> {seconds:.3f} s ({seconds / before:.2f}x)')
+    if not regressions:
+        print(f'No regressions (threshold {threshold:.2f}x)')
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for rename.py on large synthetic trees.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[ 10000 ], help='number of files (default: 10000)')
+    parser.add_argument('--layouts', nargs='+', choices=[ 'flat', 'deep' ], default=[ 'flat', 'deep' ], help='folder layouts (default: flat deep)')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='compare results with this JSON file')
+    parser.add_argument('--threshold', type=float, default=1.2, help='slowdown factor to flag as regression (default: 1.2)')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for size in args.sizes:
+        for layout in args.layouts:
+            root = tempfile.mkdtemp(prefix='rename-benchmark-')
+            try:
+                results[f'{layout}-{size}'] = runBenchmark(root, size, layout)
+            finally:
+                shutil.rmtree(root)
+
+    report = { 'python': platform.python_version(), 'platform': platform.platform(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if compare(results, baseline['results'], args.threshold):
+            exit(1)
+
+if __name__ == '__main__':
+    main()
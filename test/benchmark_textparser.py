@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import sys
+import timeit
+from pathlib import Path
+
+# import from parent dir
+PROJECT_DIR = Path(__file__).absolute().parent
+sys.path.insert(0, PROJECT_DIR.parent.as_posix())
+import textparser
+from textparser import TokenType
+
+# Usage:
+# > benchmark_textparser.py
+
+def tokenizeCharByChar(input, sep='|', includeSep=False):
+    """Previous implementation of textparser.tokenize() that builds each token char by char."""
+    if input.count(sep) % 2 == 1:
+        raise Exception(f'Syntax error: {input}')
+    tokens = []
+    t = None
+    for c in input:
+        if c == '|':
+            if t is None:
+                t = [TokenType.PLACEHOLDER, '']
+            elif t[0] == TokenType.PLACEHOLDER:
+                tokens.append(t)
+                t = None
+            elif t[0] == TokenType.TEXT:
+                tokens.append(t)
+                t = [TokenType.PLACEHOLDER, '']
+        else:
+            if t is None:
+                t = [TokenType.TEXT, '']
+            t[1] += c
+    if t is not None:
+        tokens.append(t)
+    if includeSep:
+        for t in tokens:
+            if t[0] == TokenType.PLACEHOLDER:
+                t[1] = sep + t[1] + sep
+    return tokens
+
+def main():
+    templates = {
+        'short': 'prefix-|b|_|e|',
+        'long': ' - '.join(f'|f-1| some text {i} |m:yyyy|' for i in range(50)),
+        'long text': 'x' * 5000 + '|b|',
+    }
+    number = 2000
+    for name, template in templates.items():
+        expected = [ (t.type, t.value) for t in textparser.tokenize(template, '|', True) ]
+        assert expected == [ tuple(t) for t in tokenizeCharByChar(template, '|', True) ]
+
+        before = timeit.timeit(lambda: tokenizeCharByChar(template, '|', True), number=number)
+        uncached = timeit.timeit(lambda: textparser.tokenize.__wrapped__(template, '|', True), number=number)
+        cached = timeit.timeit(lambda: textparser.tokenize(template, '|', True), number=number)
+        print(f'{name:<10} ({len(template):>5} chars): char by char {before*1000:8.2f} ms, split {uncached*1000:8.2f} ms ({before/uncached:5.1f}x), cached {cached*1000:8.2f} ms ({before/cached:7.1f}x)')
+
+if __name__ == '__main__':
+    main()
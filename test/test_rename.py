@@ -3,10 +3,18 @@
 import unittest
 import os
 import sys
+import io
+import fnmatch
 import time
 import shutil
+import tracemalloc
+import logging
+import errno
+import json
 from datetime import datetime
 from unittest import mock
+from contextlib import redirect_stdout, redirect_stderr, ExitStack
+from types import SimpleNamespace
 from unittest import TestCase
 from pathlib import Path
 
@@ -16,6 +24,7 @@ sys.path.insert(0, PROJECT_DIR.parent.as_posix())
 import rename
 ROOT_PATH = PROJECT_DIR / 'root'
 ROOT_DIR = ROOT_PATH.as_posix()
+CACHE_DIR = (PROJECT_DIR / 'cache').as_posix()
 
 # files
 MP3_WITH_ID3_TAGS = 'mp3-with-tags.mp3'
@@ -30,6 +39,13 @@ class TestRename(unittest.TestCase):
         os.makedirs(ROOT_DIR, exist_ok=True)
         shutil.rmtree(ROOT_DIR)
         os.makedirs(ROOT_DIR, exist_ok=True)
+        shutil.rmtree(CACHE_DIR, ignore_errors=True)
+        # folders are created again for each test
+        rename.caseSensitiveFolders.clear()
+        # do not use the metadata cache of the user
+        env = mock.patch.dict(os.environ, {'XDG_CACHE_HOME': CACHE_DIR})
+        env.start()
+        self.addCleanup(env.stop)
 
     def test_add(self):
         print('======= test_add ===')
@@ -58,6 +74,71 @@ class TestRename(unittest.TestCase):
         rename.main(['--debug', '-b', 'sentencecase', ROOT_DIR])
         self._assertFilesExist(ROOT_DIR, 'You\'re right.txt', 'This is my file.txt')
 
+    def test_case_only(self):
+        print('======= test_case_only ===')
+        self._createSingleFiles(ROOT_DIR, 'a.txt', 'b.txt')
+        self._createSingleFiles(os.path.join(ROOT_DIR, 'sub'), '1_2')
+        self.assertTrue(rename.isCaseSensitiveFolder(ROOT_PATH / 'a.txt'))
+        # cannot be checked without letters
+        self.assertFalse(rename.isCaseSensitiveFolder(ROOT_PATH / 'sub' / '1_2'))
+        shutil.rmtree(ROOT_PATH / 'sub')
+        # case sensitive: single rename without temp file
+        with mock.patch('rename.FileRenamer.moveToTemp', side_effect=AssertionError('temp file used')):
+            rename.main(['--debug', '-b', 'uppercase', ROOT_DIR])
+        self._assertFilesContent(ROOT_DIR, 'A.txt', 'a.txt')
+        # case insensitive: rename via temp file
+        with mock.patch('rename.isCaseSensitiveFolder', return_value=False):
+            rename.main(['--debug', '-b', 'lowercase', ROOT_DIR])
+        self._assertFilesContent(ROOT_DIR, 'a.txt', 'a.txt')
+        self._assertFilesContent(ROOT_DIR, 'b.txt', 'b.txt')
+        self.assertEqual(len(os.listdir(ROOT_DIR)), 2)
+    def test_case_only_not_overwrite(self):
+        print('======= test_case_only_not_overwrite ===')
+        self._createSingleFiles(ROOT_DIR, 'a.txt', 'A.txt')
+        with mock.patch('rename.isCaseSensitiveFolder', return_value=False):
+            with self.assertRaises(SystemExit) as cm:
+                rename.main(['--debug', '-b', 'uppercase', ROOT_DIR])
+        self.assertEqual(cm.exception.code, 2)
+        self._assertFilesContent(ROOT_DIR, 'a.txt', 'a.txt')
+        self._assertFilesContent(ROOT_DIR, 'A.txt', 'A.txt')
+        self.assertEqual(len(os.listdir(ROOT_DIR)), 2)
+    def test_case_only_restore_taken(self):
+        print('======= test_case_only_restore_taken ===')
+        self._createSingleFiles(ROOT_DIR, 'a.txt', 'A.txt')
+        moveNoReplace = rename.moveNoReplace
+        def takeName(src, dst):
+            if Path(dst).name == 'a.txt':
+                # another process takes the released name before it is restored
+                self._createSingleFiles(ROOT_DIR, 'a.txt')
+            moveNoReplace(src, dst)
+        with mock.patch('rename.isCaseSensitiveFolder', return_value=False), \
+                mock.patch('rename.moveNoReplace', side_effect=takeName):
+            with self.assertRaises(SystemExit) as cm:
+                rename.main(['--debug', '-b', 'uppercase', ROOT_DIR])
+        self.assertEqual(cm.exception.code, 2)
+        # the file is kept at its temporary name
+        tmpFiles = [ f for f in os.listdir(ROOT_DIR) if f.startswith('a.txt.') ]
+        self.assertEqual(len(tmpFiles), 1)
+        self._assertFilesContent(ROOT_DIR, tmpFiles[0], 'a.txt')
+        self.assertEqual(len(os.listdir(ROOT_DIR)), 3)
+    def test_temp_name_taken(self):
+        print('======= test_temp_name_taken ===')
+        self._createSingleFiles(ROOT_DIR, 'a_b.txt', 'b_a.txt')
+        postfixes = iter([ list('AAAAA'), list('BBBBB') ])
+        moveNoReplace = rename.moveNoReplace
+        def takeName(src, dst):
+            if Path(dst).name == 'a_b.txt.AAAAA':
+                # another process creates the temporary name after it was chosen
+                self._createSingleFiles(ROOT_DIR, 'a_b.txt.AAAAA')
+            moveNoReplace(src, dst)
+        with mock.patch('rename.random.choices', side_effect=lambda *a, **k: next(postfixes)), \
+                mock.patch('rename.moveNoReplace', side_effect=takeName):
+            rename.main(['--debug', '-b', 'swap', '_', ROOT_DIR])
+        self._assertFilesContent(ROOT_DIR, 'a_b.txt', 'b_a.txt')
+        self._assertFilesContent(ROOT_DIR, 'b_a.txt', 'a_b.txt')
+        self._assertFilesContent(ROOT_DIR, 'a_b.txt.AAAAA', 'a_b.txt.AAAAA')
+        self.assertEqual(len(os.listdir(ROOT_DIR)), 3)
+
     def test_cut(self):
         print('======= test_cut ===')
         self._createSingleFiles(ROOT_DIR, '05-you\'re right.txt', '06-this is my file.txt', 'a.txt')
@@ -91,6 +172,22 @@ class TestRename(unittest.TestCase):
         _2022Dir = str(Path(ROOT_DIR, '2022'))
         self._assertFilesExist(_2022Dir, 'IMG_2022.jpg')
 
+    def test_durable(self):
+        print('======= test_durable ===')
+        self._createSingleFiles(ROOT_DIR, 'a.txt', 'b.txt', 'c.txt')
+        subDir = str(Path(ROOT_DIR, 'sub'))
+        with mock.patch('rename.syncFolder', wraps=rename.syncFolder) as syncFolder, redirect_stderr(io.StringIO()) as err:
+            rename.main(['--debug', '--durable', '--sync-every', '2', 'replace', 'sub/|f|', ROOT_DIR])
+        self._assertFilesExist(subDir, 'a.txt', 'b.txt', 'c.txt')
+        # checkpoint after 2 renames and the end: each folder is synced once per sync
+        self.assertEqual([ c.args[0] for c in syncFolder.call_args_list ], [ ROOT_DIR, subDir, ROOT_DIR, subDir ])
+        self.assertIn('Synced 4 folders in ', err.getvalue())
+        # checkpoints without --durable are not possible
+        with self.assertRaises(SystemExit) as cm:
+            rename.main(['--sync-every', '2', 'add', 'x', ROOT_DIR])
+        self.assertEqual(cm.exception.code, 1)
+        self._assertFilesExist(subDir, 'a.txt', 'b.txt', 'c.txt')
+
     def test_file_nonexist(self):
         print('======= test_file_nonexist ===')
         with self.assertRaises(SystemExit) as cm:
@@ -119,6 +216,40 @@ class TestRename(unittest.TestCase):
         self._assertFilesExist(f1Dir, 'track-1.mp3', 'track-2.mp3', 'my_cover.jpg')
         self._assertFilesExist(f2Dir, 'track-1.mp3', 'my_track-2.mp3', 'my_cover.jpg')
 
+    def test_file_exclude_prune(self):
+        print('======= test_file_exclude_prune ===')
+        gitDir = str(Path(ROOT_DIR, '.git'))
+        objectsDir = str(Path(gitDir, 'objects'))
+        self._createSingleFiles(objectsDir, 'a.txt')
+        self._createSingleFiles(gitDir, 'config')
+        self._createSingleFiles(ROOT_DIR, 'b.txt')
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+            rename.main(['--debug', '-r', '--exclude', '*/.git/*', 'add', 'my_', ROOT_DIR])
+        scannedDirs = [ str(c.args[0]) for c in scandir.call_args_list ]
+        self.assertNotIn(gitDir, scannedDirs)
+        self.assertNotIn(objectsDir, scannedDirs)
+        self._assertFilesExist(objectsDir, 'a.txt')
+        self._assertFilesExist(gitDir, 'config')
+        self._assertFilesExist(ROOT_DIR, 'my_b.txt')
+    def test_file_exclude_prune_include(self):
+        print('======= test_file_exclude_prune_include ===')
+        gitDir = str(Path(ROOT_DIR, '.git'))
+        self._createSingleFiles(gitDir, 'config', 'HEAD')
+        rename.main(['--debug', '-r', '--exclude', '*/.git/*', '--include', '*/HEAD', 'add', 'my_', ROOT_DIR])
+        self._assertFilesExist(gitDir, 'config', 'my_HEAD')
+
+    def test_file_exclude_matcher(self):
+        print('======= test_file_exclude_matcher ===')
+        patterns = ['*.mp3', '/music/*', '/music/cover.jpg', '*/Folder ?/*', '*[0-9].txt', '*']
+        paths = ['/music/a.mp3', '/music/cover.jpg', '/other/cover.jpg', '/x/Folder 2/a.txt', '/x/Folder 22/a', '/x/a1.txt', '/x/a.txt']
+        for pattern in patterns:
+            matcher = rename.PathMatcher([pattern])
+            for path in paths:
+                self.assertEqual(matcher.matches(path), fnmatch.fnmatch(path, pattern), msg=f'{pattern}: {path}')
+        matcher = rename.PathMatcher(patterns[:-1])
+        for path in paths:
+            self.assertEqual(matcher.matches(path), any(fnmatch.fnmatch(path, p) for p in patterns[:-1]), msg=path)
+
     def test_fill(self):
         print('======= test_fill ===')
         self._createSingleFiles(ROOT_DIR, 'podcast 1 title.mp3', 'podcast 2 title.mp3', 'podcast 17 title.mp3', 'podcast 120 title.mp3')
@@ -140,6 +271,141 @@ class TestRename(unittest.TestCase):
         rename.main(['--debug', '--text-from', 'pter ', '--char-num', 'fill', '0', ROOT_DIR])
         self._assertFilesExist(ROOT_DIR, 'Chapter 01 the beginning.ext', 'Chapter 02 the next chapter.ext', 'Chapter 10 the next chapter.ext')
         
+    def test_jobs(self):
+        print('======= test_jobs ===')
+        numberDir = str(Path(ROOT_DIR, 'number'))
+        swapDir = str(Path(ROOT_DIR, 'swap'))
+        self._createFiles(numberDir, 50, '')
+        self._createSingleFiles(swapDir, 'a_b_c.txt', 'b_c_a.txt', 'c_a_b.txt')
+        fileNames = sorted(os.listdir(numberDir))
+        rename.main(['--debug', '-j', '8', '-b', 'swap', '_', swapDir])
+        self._assertFilesContent(swapDir, 'b_c_a.txt', 'a_b_c.txt')
+        self._assertFilesContent(swapDir, 'a_b_c.txt', 'c_a_b.txt')
+        rename.main(['--debug', '-j', '8', '-b', 'number', '--replace', '-s', '2', '-w', '1', numberDir])
+        for i, fileName in enumerate(fileNames):
+            self._assertFilesContent(numberDir, f'{i+2}.txt', fileName)
+
+    def test_journal_undo(self):
+        print('======= test_journal_undo ===')
+        journalFile = os.path.join(CACHE_DIR, 'journal')
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        self._createSingleFiles(ROOT_DIR, 'a_b.txt', 'b_a.txt', 'c.txt')
+        rename.main(['--debug', '--journal', journalFile, '-b', 'swap', '_', ROOT_DIR])
+        self._assertFilesContent(ROOT_DIR, 'a_b.txt', 'b_a.txt')
+        rename.main(['--debug', '--journal', journalFile + '2', 'dir', 'x/y', ROOT_DIR])
+        self._assertFilesExist(os.path.join(ROOT_DIR, 'x', 'y'), 'a_b.txt', 'b_a.txt', 'c.txt')
+        # a journal is not overwritten
+        with self.assertRaises(SystemExit) as cm:
+            rename.main(['--journal', journalFile, 'add', 'x', ROOT_DIR])
+        self.assertEqual(cm.exception.code, 1)
+
+        rename.main(['--debug', 'undo', journalFile + '2'])
+        self.assertEqual(sorted(os.listdir(ROOT_DIR)), [ 'a_b.txt', 'b_a.txt', 'c.txt' ])
+        rename.main(['--debug', 'undo', journalFile])
+        self._assertFilesContent(ROOT_DIR, 'a_b.txt', 'a_b.txt')
+        self._assertFilesContent(ROOT_DIR, 'b_a.txt', 'b_a.txt')
+        # moves are only undone once
+        rename.main(['--debug', 'undo', journalFile])
+        self._assertFilesContent(ROOT_DIR, 'a_b.txt', 'a_b.txt')
+
+    def test_journal_in_tree(self):
+        print('======= test_journal_in_tree ===')
+        journalFile = os.path.join(ROOT_DIR, 'j.log')
+        self._createSingleFiles(ROOT_DIR, 'a.txt')
+        rename.main(['--debug', '--journal', journalFile, '--stream', 'add', 'x', ROOT_DIR])
+        self.assertEqual(sorted(os.listdir(ROOT_DIR)), [ 'j.log', 'xa.txt' ])
+        os.remove(journalFile)
+        rename.main(['--debug', '--journal', journalFile, 'add', 'x', ROOT_DIR])
+        self.assertEqual(sorted(os.listdir(ROOT_DIR)), [ 'j.log', 'xxa.txt' ])
+        rename.main(['--debug', 'undo', journalFile])
+        self.assertEqual(sorted(os.listdir(ROOT_DIR)), [ 'j.log', 'xa.txt' ])
+
+    def test_journal_resume(self):
+        print('======= test_journal_resume ===')
+        journalFile = os.path.join(CACHE_DIR, 'journal')
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        self._createSingleFiles(ROOT_DIR, 'a_b.txt', 'b_a.txt', 'c_d.txt', 'd_e.txt')
+        argv = ['--debug', '--journal', journalFile, '-b', 'swap', '_', ROOT_DIR]
+        moveNoReplace = rename.moveNoReplace
+        calls = []
+        def interrupt(src, dst):
+            calls.append(src)
+            if len(calls) == 2:
+                # killed after the move: the journal does not contain the end of the move
+                moveNoReplace(src, dst)
+                raise KeyboardInterrupt()
+            moveNoReplace(src, dst)
+        with mock.patch('rename.moveNoReplace', side_effect=interrupt), self.assertRaises(KeyboardInterrupt):
+            rename.main(argv)
+        # the cycle a_b <-> b_a is interrupted: one file has a temporary name
+        self.assertEqual(len(os.listdir(ROOT_DIR)), 4)
+        # another command cannot be resumed
+        with self.assertRaises(SystemExit):
+            rename.main(['--journal', journalFile, '--resume', 'add', 'x', ROOT_DIR])
+        rename.main(argv[:1] + ['--resume'] + argv[1:])
+        self.assertEqual(sorted(os.listdir(ROOT_DIR)), [ 'a_b.txt', 'b_a.txt', 'd_c.txt', 'e_d.txt' ])
+        self._assertFilesContent(ROOT_DIR, 'a_b.txt', 'b_a.txt')
+        self._assertFilesContent(ROOT_DIR, 'd_c.txt', 'c_d.txt')
+        # the result of the interrupted move is recorded
+        with open(journalFile) as f:
+            records = list(map(json.loads, f))
+        moveIds = { r['id'] for r in records if r['op'] == 'move' }
+        self.assertEqual(moveIds, { r['id'] for r in records if r['op'] in ('done', 'failed') })
+        # a finished run cannot be resumed
+        with self.assertRaises(SystemExit):
+            rename.main(argv + ['--resume'])
+
+        # the interrupted and the resumed part are undone together
+        rename.main(['--debug', 'undo', journalFile])
+        self.assertEqual(sorted(os.listdir(ROOT_DIR)), [ 'a_b.txt', 'b_a.txt', 'c_d.txt', 'd_e.txt' ])
+        self._assertFilesContent(ROOT_DIR, 'a_b.txt', 'a_b.txt')
+
+    def test_journal_resume_incomplete(self):
+        print('======= test_journal_resume_incomplete ===')
+        journalFile = os.path.join(CACHE_DIR, 'journal')
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        self._createSingleFiles(ROOT_DIR, 'a.txt', 'b.txt', 'c.txt')
+        argv = ['--debug', '--journal', journalFile, 'add', 'x', ROOT_DIR]
+        moveNoReplace = rename.moveNoReplace
+        def interrupt(src, dst):
+            if Path(src).name == 'b.txt':
+                raise KeyboardInterrupt()
+            moveNoReplace(src, dst)
+        with mock.patch('rename.moveNoReplace', side_effect=interrupt), self.assertRaises(KeyboardInterrupt):
+            rename.main(argv)
+        # killed while the record of the move was written
+        size = os.path.getsize(journalFile)
+        os.truncate(journalFile, size - 10)
+        rename.main(['--resume'] + argv)
+        self.assertEqual(sorted(os.listdir(ROOT_DIR)), [ 'xa.txt', 'xb.txt', 'xc.txt' ])
+        with open(journalFile) as f:
+            ids = [ r['id'] for r in map(json.loads, f) if r['op'] == 'move' ]
+        self.assertEqual(ids, [ 0, 1, 2 ])
+        rename.main(['--debug', 'undo', journalFile])
+        self.assertEqual(sorted(os.listdir(ROOT_DIR)), [ 'a.txt', 'b.txt', 'c.txt' ])
+
+    def test_journal_resume_stream(self):
+        print('======= test_journal_resume_stream ===')
+        journalFile = os.path.join(CACHE_DIR, 'journal')
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        subDir = os.path.join(ROOT_DIR, 'sub')
+        self._createSingleFiles(ROOT_DIR, 'a.txt', 'b.txt')
+        self._createSingleFiles(subDir, 'c.txt', 'd.txt')
+        argv = ['--debug', '--journal', journalFile, '--stream', '-r', 'add', 'x', ROOT_DIR]
+        moveNoReplace = rename.moveNoReplace
+        def interrupt(src, dst):
+            if Path(src).name == 'd.txt':
+                raise KeyboardInterrupt()
+            moveNoReplace(src, dst)
+        with mock.patch('rename.moveNoReplace', side_effect=interrupt), self.assertRaises(KeyboardInterrupt):
+            rename.main(argv)
+        self._assertFilesExist(subDir, 'xc.txt', 'd.txt')
+        # renamed files are not renamed again
+        rename.main(['--resume'] + argv)
+        self._assertFilesExist(ROOT_DIR, 'xa.txt', 'xb.txt')
+        self._assertFilesExist(subDir, 'xc.txt', 'xd.txt')
+        self.assertEqual(len(os.listdir(subDir)), 2)
+
     def test_keep(self):
         print('======= test_keep ===')
         self._createSingleFiles(ROOT_DIR, 'A123.jpg', 'B1234.jpg', 'C12345.jpg')
@@ -167,6 +433,41 @@ class TestRename(unittest.TestCase):
         self._createSingleFiles(ROOT_DIR, 'aa.jpg', 'bb.jpg')
         rename.main(['--debug', 'replace', '|m|/|f|', ROOT_DIR])
         self._assertFilesExist(ROOT_DIR, f'{today}/aa.jpg', f'{today}/bb.jpg')
+    def test_mkdir_date(self):
+        print('======= test_mkdir_date ===')
+        self._createSingleFiles(ROOT_DIR, 'aa.jpg', 'bb.jpg')
+        mtime = datetime(2021, 3, 4, 12).timestamp()
+        os.utime(os.path.join(ROOT_DIR, 'aa.jpg'), (mtime, mtime))
+        os.utime(os.path.join(ROOT_DIR, 'bb.jpg'), (mtime, mtime))
+        with mock.patch('pathlib.Path.stat', side_effect=AssertionError('Path.stat used')):
+            rename.main(['--debug', 'replace', '|m:yyyy|/|m:mm|/|m:dd|/|f|', ROOT_DIR])
+        self._assertFilesExist(ROOT_DIR, '2021/03/04/aa.jpg', '2021/03/04/bb.jpg')
+    def test_mkdir_once(self):
+        print('======= test_mkdir_once ===')
+        fileNames = [ f'{a}_{b}_{i}.jpg' for a in 'xy' for b in 'uv' for i in range(3) ]
+        self._createSingleFiles(ROOT_DIR, *fileNames)
+        with mock.patch('os.mkdir', wraps=os.mkdir) as mkdir, mock.patch('os.path.exists', side_effect=AssertionError('os.path.exists used')):
+            rename.main(['--debug', '--pattern', '|x|_|y|_|z|', 'replace', '|x|/|y|/|z|', ROOT_DIR])
+        # 2 first level and 4 second level folders, created sorted, one call each
+        self.assertEqual([ Path(c.args[0]).relative_to(ROOT_PATH).as_posix() for c in mkdir.call_args_list ], [ 'x', 'x/u', 'x/v', 'y', 'y/u', 'y/v' ])
+        for fileName in fileNames:
+            a, b, i = fileName[:-4].split('_')
+            self._assertFilesContent(os.path.join(ROOT_DIR, a, b), f'{i}.jpg', fileName)
+    def test_mkdir_failed(self):
+        print('======= test_mkdir_failed ===')
+        self._createSingleFiles(ROOT_DIR, 'x_a.txt', 'y_b.txt')
+        moveNoReplace = rename.moveNoReplace
+        def failInY(src, dst):
+            if Path(dst).parent.name == 'y':
+                raise FileExistsError(dst)
+            moveNoReplace(src, dst)
+        with mock.patch('rename.moveNoReplace', side_effect=failInY), self.assertRaises(SystemExit) as cm:
+            rename.main(['--debug', '--pattern', '|x|_|y|', 'replace', 'new/|x|/|y|', ROOT_DIR])
+        self.assertEqual(cm.exception.code, 2)
+        # the folders created for the failed rename are removed again
+        self._assertFilesExist(os.path.join(ROOT_DIR, 'new', 'x'), 'a.txt')
+        self.assertEqual(sorted(os.listdir(os.path.join(ROOT_DIR, 'new'))), [ 'x' ])
+        self._assertFilesExist(ROOT_DIR, 'y_b.txt')
     def test_mkdir_parent(self):
         print('======= test_mkdir_parent ===')
         subDir = str(Path(ROOT_DIR, 'sub'))
@@ -188,6 +489,71 @@ class TestRename(unittest.TestCase):
         self._assertFilesExist(subDir, f'aa.txt')
         self.assertEqual(len(os.listdir(subDir)), 1)
 
+    def test_memory_per_file(self):
+        print('======= test_memory_per_file ===')
+        # target: less than 2 KB per file for a renamer with its tokens and paths (see FileRenamer)
+        fileNames = [ f'file_{i} some name.txt' for i in range(1000) ]
+        self._createSingleFiles(ROOT_DIR, *fileNames)
+        args = rename.createArgumentParser().parse_args(['--no-cache', '--text', '_', 'add', 'x', ROOT_DIR])
+        parser = rename.FilenameParser()
+        parser.init(args)
+        files = sorted(rename.getPaths(args.file, args.dirOnly, args).items())
+        # debug logging of earlier tests would be recorded by pytest
+        logger = logging.getLogger()
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.WARNING)
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        before = tracemalloc.get_traced_memory()[0]
+        renamers = rename.createRenamers(files, parser, None, args)
+        command = rename.getCommand(args, renamers, parser)
+        for renamer in renamers:
+            command(renamer, args)
+            renamer.freeze()
+            renamer.getSrcFile()
+            renamer.srcKey
+        bytesPerFile = (tracemalloc.get_traced_memory()[0] - before) / len(renamers)
+        self.assertLess(bytesPerFile, 2048)
+        self.assertFalse(hasattr(renamers[0], '__dict__'))
+        self.assertFalse(hasattr(renamers[0].tokens[0], '__dict__'))
+
+    def test_move_across_devices(self):
+        print('======= test_move_across_devices ===')
+        self._createSingleFiles(ROOT_DIR, 'a.txt', 'b.txt', 'exists.txt')
+        self._createSingleFiles(os.path.join(ROOT_DIR, 'dir'), 'c.txt')
+        if os.name != 'nt':
+            os.symlink('c.txt', os.path.join(ROOT_DIR, 'dir', 'link'))
+        os.chmod(os.path.join(ROOT_DIR, 'a.txt'), 0o640)
+        os.utime(os.path.join(ROOT_DIR, 'a.txt'), (1000000000, 1000000000))
+        exdev = OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        progress = io.StringIO()
+        progress.isatty = lambda: True
+        with ExitStack() as stack:
+            stack.enter_context(mock.patch('rename.getRenameat2', return_value=None))
+            stack.enter_context(mock.patch('os.link', side_effect=exdev))
+            stack.enter_context(mock.patch('os.rename', side_effect=exdev))
+            stack.enter_context(mock.patch('rename.PROGRESS_MIN_SIZE', 1))
+            stack.enter_context(redirect_stderr(progress))
+            rename.moveNoReplace(ROOT_PATH / 'a.txt', ROOT_PATH / 'x.txt')
+            rename.moveNoReplace(ROOT_PATH / 'dir', ROOT_PATH / 'dir2')
+            with self.assertRaises(FileExistsError):
+                rename.moveNoReplace(ROOT_PATH / 'b.txt', ROOT_PATH / 'exists.txt')
+            # without copy_file_range and sendfile
+            stack.enter_context(mock.patch('os.copy_file_range', side_effect=OSError(errno.EXDEV, 'test'), create=True))
+            stack.enter_context(mock.patch('os.sendfile', side_effect=OSError(errno.EINVAL, 'test'), create=True))
+            rename.moveNoReplace(ROOT_PATH / 'b.txt', ROOT_PATH / 'y.txt')
+        self._assertFilesNotExist(ROOT_DIR, 'a.txt', 'b.txt', 'dir')
+        self._assertFilesContent(ROOT_DIR, 'x.txt', 'a.txt')
+        self._assertFilesContent(ROOT_DIR, 'y.txt', 'b.txt')
+        self._assertFilesContent(ROOT_DIR, 'exists.txt', 'exists.txt')
+        self._assertFilesContent(os.path.join(ROOT_DIR, 'dir2'), 'c.txt', 'c.txt')
+        stat = os.stat(os.path.join(ROOT_DIR, 'x.txt'))
+        if os.name != 'nt':
+            self.assertEqual(os.readlink(os.path.join(ROOT_DIR, 'dir2', 'link')), 'c.txt')
+            self.assertEqual(stat.st_mode & 0o777, 0o640)
+        self.assertEqual(stat.st_mtime, 1000000000)
+        self.assertIn('x.txt: 100%', progress.getvalue())
+
     def test_not_overwrite_add(self):
         print('======= test_not_overwrite_add ===')
         self._createSingleFiles(ROOT_DIR, 'a.txt', '#a.txt')
@@ -221,6 +587,70 @@ class TestRename(unittest.TestCase):
         self._assertFilesContent(ROOT_DIR, '3.txt', '2.txt')
         self._assertFilesContent(ROOT_DIR, '4.txt', '3.txt')
 
+    def test_not_overwrite_swap(self):
+        print('======= test_not_overwrite_swap ===')
+        self._createSingleFiles(ROOT_DIR, 'a-b.txt', 'b-a.txt')
+        rename.main(['--debug', '-b', 'swap', '-', ROOT_DIR])
+        self._assertFilesExist(ROOT_DIR, 'a-b.txt', 'b-a.txt')
+        self._assertFilesContent(ROOT_DIR, 'a-b.txt', 'b-a.txt')
+        self._assertFilesContent(ROOT_DIR, 'b-a.txt', 'a-b.txt')
+    def test_not_overwrite_rotation(self):
+        print('======= test_not_overwrite_rotation ===')
+        self._createSingleFiles(ROOT_DIR, 'a_b_c.txt', 'b_c_a.txt', 'c_a_b.txt')
+        rename.main(['--debug', '-b', 'swap', '_', ROOT_DIR])
+        self._assertFilesContent(ROOT_DIR, 'b_c_a.txt', 'a_b_c.txt')
+        self._assertFilesContent(ROOT_DIR, 'c_a_b.txt', 'b_c_a.txt')
+        self._assertFilesContent(ROOT_DIR, 'a_b_c.txt', 'c_a_b.txt')
+        self.assertEqual(len(os.listdir(ROOT_DIR)), 3)
+    def test_not_overwrite_chain(self):
+        print('======= test_not_overwrite_chain ===')
+        self._createFiles(ROOT_DIR, 200, '')
+        fileNames = sorted(os.listdir(ROOT_DIR))
+        with mock.patch('rename.moveNoReplace', wraps=rename.moveNoReplace) as move, mock.patch('os.rename', wraps=os.rename) as osRename:
+            rename.main(['--debug', '-b', 'number', '--replace', '-s', '2', '-w', '1', ROOT_DIR])
+        # every file is moved once, cycles need one additional move to and from a temporary name
+        moves = move.call_count + osRename.call_count
+        self.assertGreaterEqual(moves, 200)
+        self.assertLess(moves, 220)
+        for i, fileName in enumerate(fileNames):
+            self._assertFilesContent(ROOT_DIR, f'{i+2}.txt', fileName)
+
+    def test_not_overwrite_race(self):
+        print('======= test_not_overwrite_race ===')
+        # dst is created by another process after planning: the move must fail even if the check for dst is skipped
+        args = SimpleNamespace(verbose=False)
+        noExists = mock.patch('os.path.exists', return_value=False)
+        noRenameat2 = mock.patch('rename.getRenameat2', return_value=None)
+        noLink = mock.patch('os.link', side_effect=PermissionError)
+        for mode, patches in { 'renameat2': [ noExists ], 'link': [ noExists, noRenameat2 ], 'check': [ noRenameat2, noLink ] }.items():
+            with self.subTest(mode):
+                shutil.rmtree(ROOT_DIR)
+                self._createSingleFiles(ROOT_DIR, 'a.txt', 'c.txt')
+                renamerA = rename.FileRenamer(ROOT_PATH / 'a.txt', [ rename.FilenameToken('a.txt', True) ])
+                renamerA.tokens[0].text = 'b.txt'
+                renamerC = rename.FileRenamer(ROOT_PATH / 'c.txt', [ rename.FilenameToken('c.txt', True) ])
+                renamerC.tokens[0].text = 'd.txt'
+                self._createSingleFiles(ROOT_DIR, 'b.txt')
+                with ExitStack() as stack:
+                    for patch in patches:
+                        stack.enter_context(patch)
+                    self.assertFalse(renamerA.rename(args))
+                    self.assertTrue(renamerC.rename(args))
+                self._assertFilesContent(ROOT_DIR, 'a.txt', 'a.txt')
+                self._assertFilesContent(ROOT_DIR, 'b.txt', 'b.txt')
+                self._assertFilesContent(ROOT_DIR, 'd.txt', 'c.txt')
+                self._assertFilesNotExist(ROOT_DIR, 'c.txt')
+
+    def test_not_overwrite_jobs(self):
+        print('======= test_not_overwrite_jobs ===')
+        self._createSingleFiles(ROOT_DIR, '11a.txt', '12a.txt', '21a.txt', '22a.txt', '77a.txt')
+        with self.assertRaises(SystemExit) as cm:
+            rename.main(['--debug', '-j', '4', '--index', '1', 'remove', ROOT_DIR])
+        self.assertEqual(cm.exception.code, 2)
+        self._assertFilesExist(ROOT_DIR, '1a.txt', '2a.txt', '21a.txt', '22a.txt', '7a.txt')
+        self._assertFilesContent(ROOT_DIR, '1a.txt', '11a.txt')
+        self._assertFilesContent(ROOT_DIR, '2a.txt', '12a.txt')
+
     def test_numbering(self):
         print('======= test_numbering ===')
         self._createSingleFiles(ROOT_DIR, 'aa.txt', 'bb.txt')
@@ -292,6 +722,87 @@ class TestRename(unittest.TestCase):
         # the calculation of the width must take into account the increment parameter
         self._assertFilesExist(ROOT_DIR, '2023-01.jpg', '2023-11.jpg')
 
+    def test_plan_apply(self):
+        print('======= test_plan_apply ===')
+        planFile = os.path.join(CACHE_DIR, 'plan.jsonl')
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        self._createSingleFiles(ROOT_DIR, 'a_b.txt', 'b_a.txt', 'c_d.txt', 'e_f.txt', 'g.txt')
+        with redirect_stdout(io.StringIO()) as out:
+            rename.main(['--debug', '--plan', planFile, '-b', 'swap', '_', ROOT_DIR])
+        self.assertIn('4 renames planned', out.getvalue())
+        self._assertFilesExist(ROOT_DIR, 'a_b.txt', 'b_a.txt', 'c_d.txt', 'e_f.txt', 'g.txt')
+        with open(planFile) as f:
+            self.assertEqual(len(f.readlines()), 7)
+
+        # changed and removed files are not renamed
+        with open(os.path.join(ROOT_DIR, 'c_d.txt'), 'a') as f:
+            f.write('changed')
+        os.remove(os.path.join(ROOT_DIR, 'e_f.txt'))
+        with redirect_stdout(io.StringIO()) as out, self.assertRaises(SystemExit) as cm:
+            rename.main(['--debug', 'apply', planFile])
+        self.assertEqual(cm.exception.code, 2)
+        self.assertEqual(out.getvalue().count('changed or removed since planning'), 2)
+        self.assertEqual(sorted(os.listdir(ROOT_DIR)), [ 'a_b.txt', 'b_a.txt', 'c_d.txt', 'g.txt' ])
+        self._assertFilesContent(ROOT_DIR, 'a_b.txt', 'b_a.txt')
+        self._assertFilesContent(ROOT_DIR, 'b_a.txt', 'a_b.txt')
+
+    def test_plan_apply_stream(self):
+        print('======= test_plan_apply_stream ===')
+        planFile = os.path.join(CACHE_DIR, 'plan.jsonl')
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        subDir = str(Path(ROOT_DIR, 'sub'))
+        self._createSingleFiles(ROOT_DIR, 'a.txt', 'b.txt')
+        self._createSingleFiles(subDir, 'c.txt')
+        rename.main(['--debug', '--plan', planFile, '--stream', '-r', 'add', 'x', ROOT_DIR])
+        # a plan is not overwritten
+        with self.assertRaises(SystemExit) as cm:
+            rename.main(['--plan', planFile, 'add', 'y', ROOT_DIR])
+        self.assertEqual(cm.exception.code, 1)
+        with redirect_stdout(io.StringIO()) as out:
+            rename.main(['-n', 'apply', planFile])
+        self.assertEqual(out.getvalue().count(' -> '), 3)
+        self._assertFilesExist(ROOT_DIR, 'a.txt', 'b.txt')
+        rename.main(['--debug', 'apply', planFile])
+        self._assertFilesExist(ROOT_DIR, 'xa.txt', 'xb.txt')
+        self._assertFilesExist(subDir, 'xc.txt')
+
+    def test_plan_incomplete(self):
+        print('======= test_plan_incomplete ===')
+        planFile = os.path.join(CACHE_DIR, 'plan.jsonl')
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        subDir = str(Path(ROOT_DIR, 'sub'))
+        self._createSingleFiles(ROOT_DIR, 'a.txt')
+        self._createSingleFiles(subDir, 'b.txt')
+        # planning fails in the second folder
+        write = rename.RenamePlan.write
+        def fail(plan, renamers):
+            if renamers[0].path.parent.name == 'sub':
+                raise rename.RenameError('Error: failed')
+            write(plan, renamers)
+        with mock.patch('rename.RenamePlan.write', autospec=True, side_effect=fail), self.assertRaises(SystemExit):
+            rename.main(['--debug', '--plan', planFile, '--stream', '-r', 'add', 'x', ROOT_DIR])
+        with open(planFile) as f:
+            self.assertIn('a.txt', f.read())
+        with self.assertRaises(SystemExit) as cm:
+            rename.main(['--debug', 'apply', planFile])
+        self.assertEqual(cm.exception.code, 1)
+        self._assertFilesExist(ROOT_DIR, 'a.txt')
+        # plans are not written by the test command
+        with self.assertRaises(SystemExit) as cm:
+            rename.main(['--plan', planFile + '2', 'test', ROOT_DIR])
+        self.assertEqual(cm.exception.code, 1)
+        self.assertFalse(os.path.exists(planFile + '2'))
+
+    def test_plan_in_tree(self):
+        print('======= test_plan_in_tree ===')
+        planFile = os.path.join(ROOT_DIR, 'p.jsonl')
+        self._createSingleFiles(ROOT_DIR, 'a.txt')
+        with redirect_stdout(io.StringIO()) as out:
+            rename.main(['--debug', '--plan', planFile, 'add', 'x', ROOT_DIR])
+        self.assertIn('1 renames planned', out.getvalue())
+        rename.main(['--debug', 'apply', planFile])
+        self.assertEqual(sorted(os.listdir(ROOT_DIR)), [ 'p.jsonl', 'xa.txt' ])
+
     def test_placeholder_audio(self):
         print('======= test_placeholder_audio ===')
         shutil.copy(MP3_WITH_ID3_TAGS, ROOT_DIR)
@@ -304,6 +815,39 @@ class TestRename(unittest.TestCase):
             rename.main(['--debug', '-b', 'replace', '|artist| - |album| - |track|', ROOT_DIR])
         self.assertEqual(cm.exception.code, 1)
         self._assertFilesExist(ROOT_DIR, MP3_NO_ARTIST)
+    def test_placeholder_audio_cache(self):
+        print('======= test_placeholder_audio_cache ===')
+        shutil.copy(MP3_WITH_ID3_TAGS, ROOT_DIR)
+        rename.main(['--debug', '-b', 'replace', '|artist| - |track|', ROOT_DIR])
+        self.assertTrue(os.path.exists(os.path.join(CACHE_DIR, 'rename', 'metadata.sqlite')))
+        # metadata must be read from the cache
+        with mock.patch('mutagen.easyid3.EasyID3', side_effect=AssertionError('EasyID3 used')):
+            rename.main(['--debug', '-b', 'replace', '|no|-|album|', ROOT_DIR])
+        self._assertFilesExist(ROOT_DIR, '01-The Album.mp3')
+    def test_placeholder_audio_prefetch(self):
+        print('======= test_placeholder_audio_prefetch ===')
+        for i in range(5):
+            shutil.copy(MP3_WITH_ID3_TAGS, os.path.join(ROOT_DIR, f'{i}.mp3'))
+        with mock.patch('rename.ThreadPoolExecutor', wraps=rename.ThreadPoolExecutor) as executor:
+            rename.main(['--debug', '--no-cache', '-b', 'number', '-b', '|artist|-', ROOT_DIR])
+        executor.assert_called_once()
+        self._assertFilesExist(ROOT_DIR, 'The Artist-10.mp3', 'The Artist-54.mp3')
+    def test_placeholder_audio_nocache(self):
+        print('======= test_placeholder_audio_nocache ===')
+        shutil.copy(MP3_WITH_ID3_TAGS, ROOT_DIR)
+        rename.main(['--debug', '--no-cache', '-b', 'replace', '|no|-|album|', ROOT_DIR])
+        self._assertFilesExist(ROOT_DIR, '01-The Album.mp3')
+        self.assertFalse(os.path.exists(os.path.join(CACHE_DIR, 'rename', 'metadata.sqlite')))
+    def test_placeholder_audio_cache_eviction(self):
+        print('======= test_placeholder_audio_cache_eviction ===')
+        cache = rename.MetadataCache(Path(CACHE_DIR, 'metadata.sqlite'), maxSize=0)
+        for i in range(10):
+            cache.put(SimpleNamespace(st_dev=0, st_ino=i, st_size=0, st_mtime_ns=0), { 'artist': [ f'Artist {i}' ] })
+        cache.close()
+        cache = rename.MetadataCache(Path(CACHE_DIR, 'metadata.sqlite'))
+        found = [ i for i in range(10) if cache.get(SimpleNamespace(st_dev=0, st_ino=i, st_size=0, st_mtime_ns=0)) is not None ]
+        cache.close()
+        self.assertEqual(len(found), 5)
     def test_placeholder_folders(self):
         print('======= test_placeholder_folders ===')
         albumDir = os.path.abspath(os.path.join(ROOT_DIR, 'rolling stones', 'beggars banquet'))
@@ -319,6 +863,31 @@ class TestRename(unittest.TestCase):
             rename.main(['add', '|notfound|_', ROOT_DIR])
         self.assertEqual(cm.exception.code, 1)
         self._assertFilesExist(ROOT_DIR, 'aa.txt')
+    def test_placeholder_notfound_noselection(self):
+        print('======= test_placeholder_notfound_noselection ===')
+        self._createSingleFiles(ROOT_DIR, 'aa.txt')
+        # unknown placeholders are detected before any file is changed
+        with self.assertRaises(SystemExit) as cm:
+            rename.main(['--text', 'xyz', 'replace', '|notfound|', ROOT_DIR])
+        self.assertEqual(cm.exception.code, 1)
+        self._assertFilesExist(ROOT_DIR, 'aa.txt')
+    def test_placeholder_compiled(self):
+        print('======= test_placeholder_compiled ===')
+        self._createFiles(ROOT_DIR, 20)
+        with mock.patch('textparser.tokenize', wraps=rename.textparser.tokenize) as tokenize:
+            rename.main(['-b', 'replace', '|b|_|e|', ROOT_DIR])
+        # once for prefetching metadata and once for the template
+        self.assertLessEqual(tokenize.call_count, 2)
+        self._assertFilesExist(ROOT_DIR, 'file-1_txt.txt', 'file-20_txt.txt')
+    def test_placeholder_tokenize(self):
+        print('======= test_placeholder_tokenize ===')
+        tokenize = rename.textparser.tokenize
+        self.assertEqual([ (t.isText(), t.value) for t in tokenize('ab|c|', '|', True) ], [ (True, 'ab'), (False, '|c|') ])
+        self.assertEqual([ (t.isText(), t.value) for t in tokenize('ab||c', '|', False) ], [ (True, 'ab'), (False, ''), (True, 'c') ])
+        self.assertEqual([ (t.isText(), t.value) for t in tokenize('|1||||2|', '|', False) ], [ (False, '1'), (False, ''), (False, '2') ])
+        self.assertEqual(tokenize('', '|', False), ())
+        with self.assertRaises(Exception):
+            tokenize('a|b', '|', False)
     def test_placeholder_reserved(self):
         print('======= test_placeholder_reserved ===')
         self._createSingleFiles(ROOT_DIR, 'aa.txt')
@@ -357,6 +926,22 @@ class TestRename(unittest.TestCase):
         rename.main(['--debug', '--text', '_', 'replace', ' ', ROOT_DIR])
         self._assertFilesExist(ROOT_DIR, 'this is a file.txt', 'another file.jpg')
 
+    def test_profile(self):
+        print('======= test_profile ===')
+        self._createSingleFiles(ROOT_DIR, 'a_1.txt', 'b_2.txt')
+        with redirect_stderr(io.StringIO()) as err:
+            rename.main(['--profile', '-b', '--text', '_', 'replace', '-', ROOT_DIR])
+        self._assertFilesExist(ROOT_DIR, 'a-1.txt', 'b-2.txt')
+        for phase in ('enumeration', 'select level 1', 'select level 3', 'command', 'rename', 'output'):
+            self.assertIn(phase, err.getvalue())
+        self.assertNotIn('select level 2', err.getvalue())
+    def test_profile_lazy_debug(self):
+        print('======= test_profile_lazy_debug ===')
+        self._createSingleFiles(ROOT_DIR, 'a_1.txt')
+        with mock.patch('rename.FilenameToken.__str__', side_effect=AssertionError('token formatted')):
+            rename.main(['-b', '--text', '_', '--pattern', '|1|', 'replace', '-', ROOT_DIR])
+        self._assertFilesExist(ROOT_DIR, 'a-1.txt')
+
     def test_remove_ext(self):
         print('======= test_remove_ext ===')
         self._createSingleFiles(ROOT_DIR, 'aa.txt', 'bb.txt')
@@ -538,6 +1123,12 @@ class TestRename(unittest.TestCase):
         self._createSingleFiles(ROOT_DIR, 'thisFileIsInCamelCase.ext', 'only1Uppercase.ext')
         rename.main(['--debug', '--char-upper', 'add', ' ', ROOT_DIR])
         self._assertFilesExist(ROOT_DIR, 'this File Is In Camel Case.ext', 'only1 Uppercase.ext')
+    def test_select_char_unicode(self):
+        print('======= test_select_char_unicode ===')
+        # same as str.isnumeric(): superscripts, fractions and CJK numerals are numeric, \d does not match them
+        self._createSingleFiles(ROOT_DIR, 'a²b½c一d12.ext', 'x1y.ext')
+        rename.main(['--debug', '-b', '--char-num', 'replace', '#', ROOT_DIR])
+        self._assertFilesExist(ROOT_DIR, 'a#b#c#d#.ext', 'x#y.ext')
 
     def test_select_index_text_1(self):
         print('======= test_index_select_1 ===')
@@ -655,6 +1246,14 @@ class TestRename(unittest.TestCase):
         self._createSingleFiles(ROOT_DIR, 'very|important.ext', 'my|file.ext')
         rename.main(['--debug', '-b', '--pattern', '|1||||2|', 'replace', '|2|_|1|_||', ROOT_DIR])
         self._assertFilesExist(ROOT_DIR, 'important_very_|.ext', 'file_my_|.ext')
+    def test_select_pattern_filewithPipe_withselect(self):
+        print('======= test_select_pattern_filewithPipe_withselect ===')
+        if os.name == 'nt':
+            print('skipped on Windows')
+            return
+        self._createSingleFiles(ROOT_DIR, 'very|important.ext', 'my|file.ext')
+        rename.main(['--debug', '-b', '--pattern', '|1||||2:s|', 'uppercase', ROOT_DIR])
+        self._assertFilesExist(ROOT_DIR, 'very|IMPORTANT.ext', 'my|FILE.ext')
 
     def test_simulate(self):
         print('======= test_simulate ===')
@@ -662,6 +1261,94 @@ class TestRename(unittest.TestCase):
         rename.main(['--debug', '-n', 'add', '#', ROOT_DIR])
         self._assertFilesExist(ROOT_DIR, 'a.txt', 'b.txt')
 
+    def test_simulate_relative_paths(self):
+        print('======= test_simulate_relative_paths ===')
+        self._createSingleFiles(ROOT_DIR, 'a.txt')
+        with redirect_stdout(io.StringIO()) as out:
+            rename.main(['-n', 'add', 'x', ROOT_DIR])
+        src = ROOT_PATH / 'a.txt'
+        dst = ROOT_PATH / 'xa.txt'
+        self.assertIn(f'{src.relative_to(os.getcwd())} -> {dst.relative_to(os.getcwd())}', out.getvalue())
+        self.assertEqual(rename.relativeToCwd(Path('/')), Path('/'))
+    def test_simulate_frozen(self):
+        print('======= test_simulate_frozen ===')
+        renamer = rename.FileRenamer(ROOT_PATH / 'a.txt', [ rename.FilenameToken('a.txt', True) ])
+        renamer.tokens[0].text = 'b.txt'
+        self.assertEqual(renamer.getDstPath(), ROOT_PATH / 'b.txt')
+        renamer.freeze()
+        renamer.tokens[0].text = 'c.txt'
+        self.assertEqual(renamer.getDstPath(), ROOT_PATH / 'b.txt')
+        self.assertEqual(renamer.getDstKey(), rename.pathKey(ROOT_PATH / 'b.txt'))
+        renamer.freeze()
+        self.assertEqual(renamer.getDstFile(), rename.relativeToCwd(ROOT_PATH / 'c.txt'))
+
+    def test_simulate_order(self):
+        print('======= test_simulate_order ===')
+        self._createSingleFiles(ROOT_DIR, 'a.txt', 'aa.txt', 'aaa.txt')
+        with redirect_stdout(io.StringIO()) as out:
+            rename.main(['-n', 'add', 'a', ROOT_DIR])
+        self.assertEqual(out.getvalue().count(' -> '), 3)
+        self.assertNotIn('Renaming failed', out.getvalue())
+        self._assertFilesContent(ROOT_DIR, 'a.txt', 'a.txt')
+        self._assertFilesContent(ROOT_DIR, 'aaa.txt', 'aaa.txt')
+    def test_simulate_not_overwrite(self):
+        print('======= test_simulate_not_overwrite ===')
+        self._createSingleFiles(ROOT_DIR, '11a.txt', '12a.txt', '21a.txt', '22a.txt', '77a.txt')
+        with redirect_stdout(io.StringIO()) as out:
+            rename.main(['-n', '--index', '1', 'remove', ROOT_DIR])
+        self.assertEqual(out.getvalue().count(' -> '), 3)
+        self.assertEqual(out.getvalue().count('Renaming failed'), 2)
+        self._assertFilesExist(ROOT_DIR, '11a.txt', '12a.txt', '21a.txt', '22a.txt', '77a.txt')
+
+    def test_stat_windows(self):
+        print('======= test_stat_windows ===')
+        self._createSingleFiles(ROOT_DIR, 'a.txt')
+        entry = next(os.scandir(ROOT_DIR))
+        renamer = rename.FileRenamer(Path(entry.path), [ rename.FilenameToken('a.txt', False) ], entry=entry)
+        # DirEntry.stat() has no device and inode on Windows
+        with mock.patch('os.name', 'nt'), mock.patch.object(os.DirEntry, 'stat', side_effect=AssertionError('DirEntry.stat used')):
+            stat = renamer.stat
+        self.assertEqual((stat.st_dev, stat.st_ino), (os.stat(entry.path).st_dev, os.stat(entry.path).st_ino))
+
+    def test_stream(self):
+        print('======= test_stream ===')
+        subDir = str(Path(ROOT_DIR, 'sub'))
+        self._createSingleFiles(ROOT_DIR, 'a.txt', 'aa.txt', 'b.txt')
+        self._createSingleFiles(subDir, 'c.txt')
+        rename.main(['--debug', '--stream', '-r', 'add', 'a', ROOT_DIR])
+        self._assertFilesExist(ROOT_DIR, 'aa.txt', 'aaa.txt', 'ab.txt')
+        self._assertFilesContent(ROOT_DIR, 'aa.txt', 'a.txt')
+        self._assertFilesExist(subDir, 'ac.txt')
+    def test_stream_dir(self):
+        print('======= test_stream_dir ===')
+        subDir = str(Path(ROOT_DIR, 'sub'))
+        os.makedirs(subDir, exist_ok=True)
+        self._createSingleFiles(ROOT_DIR, 'a.txt', 'b.txt')
+        # files moved to a folder that is walked later must not be renamed again
+        rename.main(['--debug', '--stream', '-r', 'replace', 'sub/|f|', ROOT_DIR])
+        self._assertFilesExist(subDir, 'a.txt', 'b.txt')
+        self._assertFilesNotExist(ROOT_DIR, 'a.txt', 'b.txt')
+    def test_stream_dir_symlink(self):
+        print('======= test_stream_dir_symlink ===')
+        if os.name == 'nt':
+            # creating symbolic links needs a privilege
+            print('skipped on Windows')
+            return
+        subDir = str(Path(ROOT_DIR, 'sub'))
+        os.makedirs(subDir, exist_ok=True)
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        self._createSingleFiles(ROOT_DIR, 'a.txt')
+        link = os.path.join(CACHE_DIR, 'link')
+        os.symlink(ROOT_DIR, link)
+        # enumerated paths are not resolved, moved files must not be renamed again anyway
+        rename.main(['--debug', '--stream', '-r', 'replace', 'sub/x|f|', link])
+        self.assertEqual(os.listdir(subDir), [ 'xa.txt' ])
+    def test_stream_twophases(self):
+        print('======= test_stream_twophases ===')
+        self._createSingleFiles(ROOT_DIR, 'a.txt', 'b.txt')
+        rename.main(['--debug', '--stream', 'number', '-a', '-', ROOT_DIR])
+        self._assertFilesExist(ROOT_DIR, '1-a.txt', '2-b.txt')
+
     def test_swap(self):
         print('======= test_swap ===')
         self._createSingleFiles(ROOT_DIR, '1981_video.mp4', '1985_video.mp4', 'video.mp4')
@@ -1,57 +1,46 @@
 #!/usr/bin/env python3
 
 from enum import Enum
+from functools import lru_cache
+from typing import NamedTuple
 
 class TokenType(Enum):
     TEXT = 1
     PLACEHOLDER = 2
-class TextToken:
-    def __init__(self, type):
-        self.type = type
-        self.value = ''
+class TextToken(NamedTuple):
+    type: TokenType
+    value: str = ''
 
     def isPlaceholder(self):
         return TokenType.PLACEHOLDER == self.type
-    
+
     def isText(self):
         return TokenType.TEXT == self.type
 
     def __str__(self):
         return self.value
 
+@lru_cache(maxsize=1024)
 def tokenize(input, sep='|', includeSep=False):
     """
-    Read input and return tokens. Tokens are enclosed by sep. Use sep twice to escape sep.
+    Read input and return tokens as tuple. Tokens are enclosed by sep. Use sep twice to escape sep.
     Examples:
     "a|b"     -> syntax error: single sep is not allowed
     "ab|c|"   -> ab + |c|
     "ab||c"   -> ab + || + c
     """
-    if input.count(sep) % 2 == 1:
+    parts = input.split(sep)
+    if len(parts) % 2 == 0:
         raise Exception(f'Syntax error: {input}')
-    
+
+    # parts with even index are texts, parts with odd index are enclosed by sep
     tokens = []
-    t = None
-    for c in input:
-        if c == '|':
-            if t is None:
-                t = TextToken(TokenType.PLACEHOLDER)
-            elif t.type == TokenType.PLACEHOLDER:
-                tokens.append(t)
-                t = None
-            elif t.type == TokenType.TEXT:
-                tokens.append(t)
-                t = TextToken(TokenType.PLACEHOLDER)
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            if part:
+                tokens.append(TextToken(TokenType.TEXT, part))
+        elif includeSep:
+            tokens.append(TextToken(TokenType.PLACEHOLDER, sep + part + sep))
         else:
-            if t is None:
-                t = TextToken(TokenType.TEXT)
-            t.value += c
-    if t is not None:
-        tokens.append(t)
-    
-    if includeSep:
-        for t in tokens:
-            if t.isPlaceholder():
-                t.value = sep + t.value + sep
-    return tokens
-    
+            tokens.append(TextToken(TokenType.PLACEHOLDER, part))
+    return tuple(tokens)